@@ -1,12 +1,28 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, get_flashed_messages, jsonify, g, has_request_context, abort, Response, stream_with_context, stream_template
 from werkzeug.security import generate_password_hash, check_password_hash
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.pool
 from psycopg2 import IntegrityError
 import os
-from datetime import datetime
+import io
+import csv
+import tempfile
+import zlib
+import hashlib
+import heapq
+import json
+import queue
+import select
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
-from openpyxl import load_workbook
+from openpyxl import load_workbook, Workbook
+import click
 
 # -------------------------------------------------------
 # CONFIG
@@ -19,18 +35,170 @@ app = Flask(__name__)
 app.secret_key = "change-this-secret-please"
 
 # -------------------------------------------------------
-# DB HELPERS (POSTGRESQL)
+# DB HELPERS (POSTGRESQL) : pool de connexions
 # -------------------------------------------------------
+# Chaque requête HTTP emprunte UNE connexion au pool (gardée dans flask.g
+# et rendue au teardown, ou à la fermeture de la réponse pour stream_page).
+# Hors requête (CLI, import, démarrage), get_db() emprunte une connexion que
+# close() rend au pool.
+# WEB_THREADS doit suivre `--threads` du Procfile : une connexion par thread
+# du worker, les flux /events n'en gardent aucune.
+WEB_THREADS = int(os.environ.get("WEB_THREADS", "16"))
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", str(WEB_THREADS)))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+
+_pool_lock = threading.Lock()
+_pool_state = {"pool": None, "slots": None, "pid": None}
+_pool_stats = {
+    "borrowed": 0,
+    "in_use": 0,
+    "peak_in_use": 0,
+    "waits": 0,
+    "timeouts": 0,
+    "wait_time_total": 0.0,
+    "wait_time_max": 0.0,
+}
+
+
+def _get_pool():
+    # le pool est créé à la demande, une fois par processus (fork gunicorn)
+    with _pool_lock:
+        if _pool_state["pool"] is None or _pool_state["pid"] != os.getpid():
+            _pool_state["pool"] = psycopg2.pool.ThreadedConnectionPool(
+                DB_POOL_MIN,
+                DB_POOL_MAX,
+                os.environ["DATABASE_URL"],
+                cursor_factory=psycopg2.extras.RealDictCursor
+            )
+            _pool_state["slots"] = threading.BoundedSemaphore(DB_POOL_MAX)
+            _pool_state["pid"] = os.getpid()
+        return _pool_state["pool"], _pool_state["slots"]
+
+
+def _acquire_conn():
+    pool, slots = _get_pool()
+
+    start = time.perf_counter()
+    if not slots.acquire(blocking=False):
+        with _pool_lock:
+            _pool_stats["waits"] += 1
+        if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+            with _pool_lock:
+                _pool_stats["timeouts"] += 1
+            raise psycopg2.pool.PoolError("pool de connexions saturé")
+    waited = time.perf_counter() - start
+
+    try:
+        conn = pool.getconn()
+    except Exception:
+        slots.release()
+        raise
+
+    with _pool_lock:
+        _pool_stats["borrowed"] += 1
+        _pool_stats["in_use"] += 1
+        _pool_stats["peak_in_use"] = max(_pool_stats["peak_in_use"], _pool_stats["in_use"])
+        _pool_stats["wait_time_total"] += waited
+        _pool_stats["wait_time_max"] = max(_pool_stats["wait_time_max"], waited)
+    return conn
+
+
+def _release_conn(conn):
+    pool, slots = _get_pool()
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            broken = True
+    try:
+        pool.putconn(conn, close=broken)
+    finally:
+        slots.release()
+        with _pool_lock:
+            _pool_stats["in_use"] -= 1
+
+
+class _PooledConnection:
+    """Connexion empruntée au pool : close() la rend au lieu de la fermer.
+
+    Dans une requête, le dernier close() annule la transaction non validée
+    (comme la fermeture d'une connexion dédiée) ; la connexion est rendue
+    au pool par le teardown.
+    """
+
+    def __init__(self, conn, request_scoped):
+        self._conn = conn
+        self._request_scoped = request_scoped
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        if not self._request_scoped:
+            _release_conn(self._conn)
+            return
+        if g.get("db_conn") is not self._conn:
+            # cédée à une réponse en flux : rendue à la fermeture de celle-ci
+            return
+        g.db_refs -= 1
+        if g.db_refs == 0 and not self._conn.closed and (
+            self._conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        ):
+            self._conn.rollback()
+
+
 def get_db():
-    return psycopg2.connect(
-        os.environ["DATABASE_URL"],
-        cursor_factory=psycopg2.extras.RealDictCursor
+    if not has_request_context():
+        return _PooledConnection(_acquire_conn(), request_scoped=False)
+
+    conn = g.get("db_conn")
+    if conn is None or conn.closed:
+        if conn is not None:
+            _release_conn(conn)
+        conn = _acquire_conn()
+        g.db_conn = conn
+        g.db_refs = 0
+    g.db_refs += 1
+    return _PooledConnection(conn, request_scoped=True)
+
+
+@app.teardown_appcontext
+def _teardown_db(exc):
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        _release_conn(conn)
+
+
+def db_pool_stats():
+    with _pool_lock:
+        stats = dict(_pool_stats)
+    stats["min"] = DB_POOL_MIN
+    stats["max"] = DB_POOL_MAX
+    stats["saturation"] = round(stats["in_use"] / DB_POOL_MAX, 3) if DB_POOL_MAX else 0
+    stats["wait_time_avg"] = (
+        stats["wait_time_total"] / stats["borrowed"] if stats["borrowed"] else 0.0
     )
+    return stats
+
+# -------------------------------------------------------
+# MIGRATIONS DU SCHÉMA (table schema_version)
+# -------------------------------------------------------
+# Chaque étape est appliquée une seule fois, dans l'ordre, dans sa propre
+# transaction. Un verrou consultatif garantit qu'un seul processus migre ;
+# les autres attendent puis constatent que le schéma est à jour.
+MIGRATION_LOCK_KEY = 7_340_001
+# attente entre deux tentatives de prise du verrou de migration (s)
+MIGRATION_LOCK_POLL = 1.0
 
-def init_db():
-    conn = get_db()
-    cur = conn.cursor()
 
+def _m001_initial_schema(cur):
     # ---------- USERS ----------
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users(
@@ -144,22 +312,891 @@ def init_db():
     """)
 
 
-    conn.commit()
+def _m002_users_version(cur):
+    cur.execute("""
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1
+    """)
+
+
+def _m003_task_templates(cur):
+    # ---------- PLAN PMP (import du classeur Excel) ----------
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS task_templates(
+        id SERIAL PRIMARY KEY,
+        source_key TEXT UNIQUE NOT NULL,
+        row_hash TEXT NOT NULL,
+        line TEXT NOT NULL,
+        machine TEXT NOT NULL,
+        description TEXT,
+        frequency TEXT,
+        intervenant TEXT,
+        documentation TEXT,
+        imported_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS task_templates_line_frequency_idx
+    ON task_templates(line, frequency)
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS task_templates_line_machine_idx
+    ON task_templates(line, machine)
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS task_template_imports(
+        id SERIAL PRIMARY KEY,
+        source_path TEXT NOT NULL,
+        source_mtime_ns BIGINT NOT NULL,
+        source_size BIGINT NOT NULL,
+        inserted INTEGER NOT NULL DEFAULT 0,
+        updated INTEGER NOT NULL DEFAULT 0,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        imported_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+# ---------- INDEX DES REQUÊTES CHAUDES ----------
+# (nom, table, colonnes + prédicat partiel éventuel). Créés en CONCURRENTLY
+# par la migration 4 et réutilisés par `flask check-indexes`.
+HOT_INDEXES = [
+    # /me : tâches de l'opérateur, récentes d'abord + KPI opérateur (migration 17 : supprimé)
+    ("tasks_assignee_created_idx", "tasks", "(assigned_to, created_at DESC)"),
+    # tâches ouvertes par assigné (vues chef d'équipe) (migration 17 : supprimé)
+    ("tasks_open_assignee_idx", "tasks",
+     "(assigned_to, created_at DESC) WHERE status='en_cours'"),
+    # clôtures à confirmer par le chef d'équipe (migration 17 : supprimé)
+    ("tasks_unvalidated_idx", "tasks",
+     "(assigned_to, closed_at DESC) WHERE status='cloturee' AND validated_by_leader = FALSE"),
+    # listes admin ouvertes / clôturées
+    ("tasks_open_created_idx", "tasks",
+     "(created_at DESC, id DESC) WHERE status='en_cours'"),
+    ("tasks_closed_at_idx", "tasks",
+     "(closed_at DESC, id DESC) WHERE status='cloturee'"),
+    # filtres ligne / machine / dates (KPI, listes admin)
+    ("tasks_line_machine_created_idx", "tasks", "(line, machine, created_at)"),
+    ("tasks_created_at_idx", "tasks", "(created_at)"),
+    ("users_team_leader_idx", "users", "(team_leader_id)"),
+    ("users_prod_line_idx", "users", "(prod_line)"),
+    ("feedback_form_task_idx", "feedback_form", "(task_id)"),
+    ("feedback_form_untreated_idx", "feedback_form",
+     "(created_at DESC) WHERE treated = FALSE"),
+    ("machine_anomalies_untreated_idx", "machine_anomalies",
+     "(created_at DESC) WHERE treated = FALSE"),
+]
+
+
+# ---------- FRÉQUENCES NORMALISÉES ----------
+# Le plan PMP écrit les fréquences librement (« Hebdomadaire », « Mensuelle »…).
+# frequency_code en garde la forme canonique, calculée par la base à chaque
+# écriture (colonne générée) : les filtres deviennent des égalités indexées.
+PMP_FREQUENCIES = ["quotidien", "hebdo", "mensuel", "trimestriel", "semestriel", "annuel"]
+
+
+def period_key(freq_prefix, day):
+    """Période couverte par une génération : 2026-10-17, 2026-W42, 2026-10, 2026-Q4, 2026-S2, 2026."""
+    if freq_prefix == "quotidien":
+        return day.isoformat()
+    if freq_prefix == "hebdo":
+        year, week, _ = day.isocalendar()
+        return f"{year}-W{week:02d}"
+    if freq_prefix == "mensuel":
+        return f"{day.year}-{day.month:02d}"
+    if freq_prefix == "trimestriel":
+        return f"{day.year}-Q{(day.month - 1) // 3 + 1}"
+    if freq_prefix == "semestriel":
+        return f"{day.year}-S{1 if day.month <= 6 else 2}"
+    return str(day.year)
+
+
+_FREQUENCY_CODE_FUNCTION = """
+CREATE OR REPLACE FUNCTION pmp_frequency_code(value TEXT) RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT CASE
+        {cases}
+    END
+$$
+""".format(cases="\n        ".join(
+    f"WHEN LOWER(value) LIKE '%{code}%' THEN '{code}'" for code in PMP_FREQUENCIES
+))
+
+# posés par la migration 8 (la colonne n'existe pas encore à la migration 4)
+FREQUENCY_INDEXES = [
+    # /me : filtre par bouton de fréquence (migration 17 : supprimé)
+    ("tasks_assignee_frequency_created_idx", "tasks",
+     "(assigned_to, frequency_code, created_at DESC)"),
+]
+
+
+# ---------- ÉCHÉANCES ----------
+# due_at = création + durée de la période de la fréquence (colonne générée).
+# Sans fréquence reconnue, la tâche est due sous 7 jours.
+DUE_INTERVALS = {
+    "quotidien": "1 day",
+    "hebdo": "7 days",
+    "mensuel": "1 month",
+    "trimestriel": "3 months",
+    "semestriel": "6 months",
+    "annuel": "1 year",
+}
+DEFAULT_DUE_INTERVAL = "7 days"
+
+_DUE_INTERVAL_FUNCTION = """
+CREATE OR REPLACE FUNCTION pmp_due_interval(code TEXT) RETURNS INTERVAL
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT CASE code
+        {cases}
+        ELSE INTERVAL '{default}'
+    END
+$$
+""".format(
+    cases="\n        ".join(f"WHEN '{code}' THEN INTERVAL '{i}'" for code, i in DUE_INTERVALS.items()),
+    default=DEFAULT_DUE_INTERVAL,
+)
+
+# posés par la migration 10 ; les index partiels ne portent que sur les
+# tâches ouvertes, quelle que soit la profondeur de l'historique
+DUE_INDEXES = [
+    # /me : tâches de la période en cours
+    ("tasks_assignee_due_idx", "tasks", "(assigned_to, due_at)"),
+    # retards / à risque par ligne, machine, opérateur
+    ("tasks_open_due_idx", "tasks", "(due_at) WHERE status='en_cours'"),
+    ("tasks_open_line_machine_due_idx", "tasks",
+     "(line, machine, due_at) WHERE status='en_cours'"),
+    # (migration 17 : supprimé)
+    ("tasks_open_assignee_due_idx", "tasks",
+     "(assigned_to, due_at) WHERE status='en_cours'"),
+]
+
+
+# ---------- COMPTEURS PAR UTILISATEUR ----------
+# Valeurs de référence de user_stats, recalculées depuis tasks
+# (remplissage initial et `flask reconcile-stats`).
+_USER_STATS_FROM_TASKS = """
+    SELECT
+        t.assigned_to AS user_id,
+        COUNT(*) FILTER (WHERE t.status='en_cours') AS open_count,
+        COUNT(*) FILTER (WHERE t.status='cloturee') AS closed_count,
+        COALESCE(SUM(t.points) FILTER (WHERE t.status='cloturee'), 0) AS score,
+        MAX(t.closed_at) FILTER (WHERE t.status='cloturee') AS last_closed_at
+    FROM tasks t
+    JOIN users u ON u.id = t.assigned_to
+    GROUP BY t.assigned_to
+"""
+
+
+# ---------- ÉVÉNEMENTS (LISTEN / NOTIFY) ----------
+EVENTS_CHANNEL = "pmp_events"
+
+# posés par la migration 15 : deltas des tableaux de bord (?since=)
+DELTA_INDEXES = [
+    ("tasks_assignee_updated_idx", "tasks", "(assigned_to, updated_at)"),
+]
+
+# posés par la migration 17, qui supprime SUPERSEDED_INDEXES : /me et la
+# file du chef d'équipe filtrent sur due_at, le KPI opérateur lit user_stats
+# (la file du chef d'équipe et ses retards passent par les index globaux
+# d'échéance / de clôture, plus sélectifs que les index par assigné)
+DASHBOARD_INDEXES = [
+    # /me : tâches sans fréquence, affichées hors période (OR avec due_at)
+    ("tasks_assignee_manual_idx", "tasks", "(assigned_to) WHERE frequency IS NULL"),
+]
+SUPERSEDED_INDEXES = [
+    "tasks_assignee_created_idx",
+    "tasks_open_assignee_idx",
+    "tasks_unvalidated_idx",
+    "tasks_assignee_frequency_created_idx",
+    "tasks_open_assignee_due_idx",
+]
+
+
+def _create_index_concurrently(cur, name, table, definition):
+    # un CREATE INDEX CONCURRENTLY interrompu laisse un index invalide : on le refait
+    cur.execute("""
+        SELECT i.indisvalid
+        FROM pg_index i
+        WHERE i.indexrelid = to_regclass(%s)
+    """, (name,))
+    row = cur.fetchone()
+    if row and not row["indisvalid"]:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}")
+
+
+def _m004_hot_indexes(cur):
+    for name, table, definition in HOT_INDEXES:
+        _create_index_concurrently(cur, name, table, definition)
+
+
+def _m005_generation_batches(cur):
+    # un lot par (ligne, fréquence, période) : une génération rejouée ne double rien
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS generation_batches(
+        id SERIAL PRIMARY KEY,
+        line TEXT NOT NULL,
+        frequency TEXT NOT NULL,
+        period TEXT NOT NULL,
+        created_count INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (line, frequency, period)
+    )
+    """)
+    cur.execute("""
+    ALTER TABLE tasks
+    ADD COLUMN IF NOT EXISTS batch_id INTEGER REFERENCES generation_batches(id) ON DELETE SET NULL
+    """)
+    cur.execute("""
+    ALTER TABLE tasks
+    ADD COLUMN IF NOT EXISTS template_key TEXT
+    """)
+
+
+def _m006_generated_tasks_unique(cur):
+    cur.execute("""
+        SELECT i.indisvalid
+        FROM pg_index i
+        WHERE i.indexrelid = to_regclass('tasks_batch_template_uidx')
+    """)
+    row = cur.fetchone()
+    if row and not row["indisvalid"]:
+        cur.execute("DROP INDEX CONCURRENTLY IF EXISTS tasks_batch_template_uidx")
+    cur.execute("""
+    CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS tasks_batch_template_uidx
+    ON tasks(batch_id, template_key)
+    WHERE batch_id IS NOT NULL
+    """)
+
+
+def _m007_frequency_code(cur):
+    cur.execute(_FREQUENCY_CODE_FUNCTION)
+    # colonnes générées : les lignes existantes sont calculées à l'ajout
+    for table in ("tasks", "task_templates"):
+        cur.execute(f"""
+        ALTER TABLE {table}
+        ADD COLUMN IF NOT EXISTS frequency_code TEXT
+        GENERATED ALWAYS AS (pmp_frequency_code(frequency)) STORED
+        """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS task_templates_line_frequency_code_idx
+    ON task_templates(line, frequency_code)
+    """)
+
+
+def _m008_frequency_indexes(cur):
+    for name, table, definition in FREQUENCY_INDEXES:
+        _create_index_concurrently(cur, name, table, definition)
+
+
+def _m009_due_at(cur):
+    cur.execute(_DUE_INTERVAL_FUNCTION)
+    cur.execute("""
+    ALTER TABLE tasks
+    ADD COLUMN IF NOT EXISTS due_at TIMESTAMP
+    GENERATED ALWAYS AS (created_at + pmp_due_interval(pmp_frequency_code(frequency))) STORED
+    """)
+
+
+def _m010_due_indexes(cur):
+    for name, table, definition in DUE_INDEXES:
+        _create_index_concurrently(cur, name, table, definition)
+
+
+def _m011_user_stats(cur):
+    # compteurs par utilisateur, tenus à jour dans la transaction qui
+    # modifie les tâches (voir _apply_user_stats)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_stats(
+        user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+        open_count INTEGER NOT NULL DEFAULT 0,
+        closed_count INTEGER NOT NULL DEFAULT 0,
+        score INTEGER NOT NULL DEFAULT 0,
+        last_closed_at TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute(f"""
+    INSERT INTO user_stats(user_id, open_count, closed_count, score, last_closed_at)
+    {_USER_STATS_FROM_TASKS}
+    ON CONFLICT (user_id) DO NOTHING
+    """)
+
+
+def _m012_operator_daily_perf(cur):
+    # agrégat (opérateur × ligne × machine × jour de création) pour la page
+    # de performance ; rafraîchi en CONCURRENTLY (index unique requis)
+    cur.execute("""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS operator_daily_perf AS
+    SELECT
+        t.assigned_to AS user_id,
+        t.line,
+        t.machine,
+        t.created_at::date AS day,
+        COUNT(*) AS total_tasks,
+        COUNT(*) FILTER (WHERE t.status='cloturee') AS completed_tasks,
+        COALESCE(SUM(t.points) FILTER (WHERE t.status='cloturee'), 0) AS score
+    FROM tasks t
+    WHERE t.assigned_to IS NOT NULL
+    GROUP BY t.assigned_to, t.line, t.machine, t.created_at::date
+    """)
+    cur.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS operator_daily_perf_uidx
+    ON operator_daily_perf(user_id, line, machine, day)
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS operator_daily_perf_day_line_idx
+    ON operator_daily_perf(day, line)
+    """)
+
+
+def _m013_sync_operations(cur):
+    # clés d'idempotence des tablettes : une opération rejouée renvoie
+    # le résultat déjà enregistré au lieu d'être appliquée deux fois
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sync_operations(
+        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        key TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        result JSONB,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, key)
+    )
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS sync_operations_created_idx
+    ON sync_operations(created_at)
+    """)
+
+
+def _m014_tasks_updated_at(cur):
+    cur.execute("""
+    ALTER TABLE tasks
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP
+    """)
+    cur.execute("""
+    UPDATE tasks
+    SET updated_at = COALESCE(closed_at, created_at)
+    WHERE updated_at IS NULL
+    """)
+    cur.execute("""
+    ALTER TABLE tasks
+    ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP,
+    ALTER COLUMN updated_at SET NOT NULL
+    """)
+    # toute modification d'une tâche (clôture, validation...) date la ligne.
+    # La comparaison se fait dans la fonction : la clause WHEN d'un trigger
+    # BEFORE ne peut pas référencer NEW.* (colonnes générées), et celles-ci
+    # ne sont pas encore calculées dans NEW ; on les ignore donc.
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION tasks_touch_updated_at() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF to_jsonb(NEW) - 'updated_at' - 'frequency_code' - 'due_at'
+           IS DISTINCT FROM
+           to_jsonb(OLD) - 'updated_at' - 'frequency_code' - 'due_at' THEN
+            NEW.updated_at := NOW();
+        END IF;
+        RETURN NEW;
+    END
+    $$
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS tasks_touch_updated_at ON tasks")
+    cur.execute("""
+    CREATE TRIGGER tasks_touch_updated_at
+    BEFORE UPDATE ON tasks
+    FOR EACH ROW
+    EXECUTE FUNCTION tasks_touch_updated_at()
+    """)
+
+
+def _m015_delta_indexes(cur):
+    for name, table, definition in DELTA_INDEXES:
+        _create_index_concurrently(cur, name, table, definition)
+
+
+def _m016_event_triggers(cur):
+    # événements poussés aux navigateurs (voir _EventHub) ; NOTIFY n'est
+    # délivré qu'au COMMIT, une transaction annulée n'émet rien
+    cur.execute(f"""
+    CREATE OR REPLACE FUNCTION pmp_notify_task_event() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        kind TEXT;
+    BEGIN
+        IF OLD.status = 'en_cours' AND NEW.status = 'cloturee' THEN
+            kind := 'task_closed';
+        ELSIF NEW.validated_by_leader IS TRUE AND OLD.validated_by_leader IS NOT TRUE THEN
+            kind := 'task_validated';
+        ELSE
+            RETURN NULL;
+        END IF;
+        PERFORM pg_notify('{EVENTS_CHANNEL}', json_build_object(
+            'type', kind,
+            'task_id', NEW.id,
+            'line', NEW.line,
+            'machine', NEW.machine,
+            'assigned_to', NEW.assigned_to,
+            'team_leader_id', (SELECT team_leader_id FROM users WHERE id = NEW.assigned_to),
+            'at', NOW()
+        )::text);
+        RETURN NULL;
+    END
+    $$
+    """)
+    cur.execute(f"""
+    CREATE OR REPLACE FUNCTION pmp_notify_anomaly() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('{EVENTS_CHANNEL}', json_build_object(
+            'type', 'anomaly',
+            'anomaly_id', NEW.id,
+            'line', NEW.line,
+            'machine', NEW.machine,
+            'severity', NEW.severity,
+            'user_id', NEW.user_id,
+            'team_leader_id', (SELECT team_leader_id FROM users WHERE id = NEW.user_id),
+            'at', NOW()
+        )::text);
+        RETURN NULL;
+    END
+    $$
+    """)
+    cur.execute(f"""
+    CREATE OR REPLACE FUNCTION pmp_notify_feedback() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('{EVENTS_CHANNEL}', json_build_object(
+            'type', 'feedback',
+            'feedback_id', NEW.id,
+            'task_id', NEW.task_id,
+            'user_id', NEW.user_id,
+            'team_leader_id', (SELECT team_leader_id FROM users WHERE id = NEW.user_id),
+            'at', NOW()
+        )::text);
+        RETURN NULL;
+    END
+    $$
+    """)
+    for trigger, table, when, function in (
+        ("tasks_notify_event", "tasks", "UPDATE OF status, validated_by_leader", "pmp_notify_task_event"),
+        ("machine_anomalies_notify", "machine_anomalies", "INSERT", "pmp_notify_anomaly"),
+        ("feedback_form_notify", "feedback_form", "INSERT", "pmp_notify_feedback"),
+    ):
+        cur.execute(f"DROP TRIGGER IF EXISTS {trigger} ON {table}")
+        cur.execute(f"""
+        CREATE TRIGGER {trigger}
+        AFTER {when} ON {table}
+        FOR EACH ROW
+        EXECUTE FUNCTION {function}()
+        """)
+
+
+def _m017_dashboard_indexes(cur):
+    for name, table, definition in DASHBOARD_INDEXES:
+        _create_index_concurrently(cur, name, table, definition)
+    for name in SUPERSEDED_INDEXES:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def _m018_backfill_generation_batches(cur):
+    # tâches générées avant le registre (batch_id NULL) : la période en cours
+    # est marquée générée, sinon le premier passage du planificateur la referait
+    today = datetime.now().date()
+    cur.execute("""
+        SELECT line, frequency_code, created_at::date AS day, COUNT(*) AS n
+        FROM tasks
+        WHERE batch_id IS NULL
+        AND frequency_code IS NOT NULL
+        AND created_at >= date_trunc('year', CURRENT_DATE) - INTERVAL '7 days'
+        GROUP BY line, frequency_code, created_at::date
+    """)
+    counts = defaultdict(int)
+    for r in cur.fetchall():
+        period = period_key(r["frequency_code"], today)
+        if period_key(r["frequency_code"], r["day"]) == period:
+            counts[(r["line"], r["frequency_code"], period)] += r["n"]
+    if counts:
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO generation_batches(line, frequency, period, created_count)
+            VALUES %s
+            ON CONFLICT (line, frequency, period) DO NOTHING
+        """, [(l, f, p, n) for (l, f, p), n in counts.items()])
+
+
+# (version, nom, étape, transactionnelle) ; une étape non transactionnelle
+# s'exécute en autocommit (CREATE INDEX CONCURRENTLY).
+MIGRATIONS = [
+    (1, "schéma initial", _m001_initial_schema, True),
+    (2, "users.version", _m002_users_version, True),
+    (3, "table task_templates", _m003_task_templates, True),
+    (4, "index des requêtes chaudes", _m004_hot_indexes, False),
+    (5, "registre des générations PMP", _m005_generation_batches, True),
+    (6, "unicité des tâches générées", _m006_generated_tasks_unique, False),
+    (7, "fréquences normalisées", _m007_frequency_code, True),
+    (8, "index des fréquences", _m008_frequency_indexes, False),
+    (9, "échéances des tâches", _m009_due_at, True),
+    (10, "index des échéances", _m010_due_indexes, False),
+    (11, "compteurs par utilisateur", _m011_user_stats, True),
+    (12, "vue de performance opérateurs", _m012_operator_daily_perf, True),
+    (13, "opérations de synchronisation", _m013_sync_operations, True),
+    (14, "tasks.updated_at", _m014_tasks_updated_at, True),
+    (15, "index des deltas", _m015_delta_indexes, False),
+    (16, "événements NOTIFY", _m016_event_triggers, True),
+    (17, "index du tableau de bord opérateur", _m017_dashboard_indexes, False),
+    (18, "registre des générations : périodes en cours", _m018_backfill_generation_batches, True),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _current_schema_version(cur):
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL AS ok")
+    if not cur.fetchone()["ok"]:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_version")
+    return cur.fetchone()["v"]
+
+
+def migrate_db(target=None):
+    """Applique les migrations en attente ; retourne les versions appliquées."""
+    conn = get_db()
+    cur = conn.cursor()
+    # attente en autocommit, sans transaction ouverte : un worker bloqué dans
+    # pg_advisory_lock garderait un snapshot que CREATE INDEX CONCURRENTLY
+    # (lancé par le migrateur) attendrait indéfiniment
+    conn.set_session(autocommit=True)
+    try:
+        while True:
+            cur.execute("SELECT pg_try_advisory_lock(%s) AS ok", (MIGRATION_LOCK_KEY,))
+            if cur.fetchone()["ok"]:
+                break
+            time.sleep(MIGRATION_LOCK_POLL)
+    finally:
+        conn.set_session(autocommit=False)
+
+    applied = []
+    try:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version(
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        conn.commit()
+
+        current = _current_schema_version(cur)
+        # clôt la transaction de lecture : set_session(autocommit=True) est
+        # refusé dans une transaction ouverte (étapes non transactionnelles)
+        conn.commit()
+        for version, name, step, transactional in MIGRATIONS:
+            if version <= current or (target is not None and version > target):
+                continue
+            print(f">>> MIGRATION {version} : {name}")
+            if transactional:
+                step(cur)
+            else:
+                conn.set_session(autocommit=True)
+                try:
+                    step(cur)
+                finally:
+                    conn.set_session(autocommit=False)
+            cur.execute(
+                "INSERT INTO schema_version(version, name) VALUES (%s,%s)",
+                (version, name)
+            )
+            conn.commit()
+            applied.append(version)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+        conn.commit()
+        cur.close()
+        conn.close()
+
+    return applied
+
+
+def ensure_schema():
+    # démarrage : simple lecture de la version, migration seulement si en retard
+    conn = get_db()
+    cur = conn.cursor()
+    current = _current_schema_version(cur)
     cur.close()
     conn.close()
 
+    if current < SCHEMA_VERSION:
+        migrate_db()
+
+
+@app.cli.command("db-upgrade")
+@click.option("--target", type=int, default=None, help="Version cible (défaut : la dernière).")
+def db_upgrade_command(target):
+    """Applique les migrations du schéma en attente."""
+    applied = migrate_db(target)
+    if applied:
+        click.echo(f"Migrations appliquées : {', '.join(map(str, applied))}")
+    else:
+        click.echo(f"Schéma déjà à jour (version {SCHEMA_VERSION}).")
+
+
+@app.cli.command("db-version")
+def db_version_command():
+    """Affiche la version du schéma en base."""
+    conn = get_db()
+    cur = conn.cursor()
+    current = _current_schema_version(cur)
+    conn.close()
+    click.echo(f"Schéma en base : {current} / code : {SCHEMA_VERSION}")
+
+
+# -------------------------------------------------------
+# CONTRÔLE EXPLAIN DES INDEX (table synthétique)
+# -------------------------------------------------------
+# Requêtes représentatives des pages chaudes et LEUR index attendu. Le contrôle
+# crée un schéma jetable, y génère `rows` tâches, pose les index en vigueur
+# (hors SUPERSEDED_INDEXES) puis vérifie par EXPLAIN que chaque requête
+# utilise son index et ne parcourt pas tasks séquentiellement.
+HOT_QUERIES = [
+    ("operator_dashboard", """
+        SELECT * FROM tasks
+        WHERE assigned_to = %(user_id)s
+        AND (
+            due_at > NOW() OR frequency IS NULL
+            OR (status = 'en_cours' AND due_at > NOW() - INTERVAL '7 days')
+        )
+        ORDER BY CASE status WHEN 'en_cours' THEN 0 ELSE 1 END, due_at
+    """, "tasks_assignee_due_idx"),
+    ("operator_dashboard_freq", """
+        SELECT * FROM tasks
+        WHERE assigned_to = %(user_id)s
+        AND (
+            due_at > NOW() OR frequency IS NULL
+            OR (status = 'en_cours' AND due_at > NOW() - INTERVAL '7 days')
+        )
+        AND frequency_code = 'hebdo'
+        ORDER BY CASE status WHEN 'en_cours' THEN 0 ELSE 1 END, due_at
+    """, "tasks_assignee_due_idx"),
+    ("leader_review_queue", """
+        SELECT t.*, u.username
+        FROM users u
+        JOIN tasks t ON t.assigned_to = u.id
+        WHERE u.team_leader_id = %(leader_id)s
+        AND (
+            (t.status = 'en_cours' AND t.due_at >= NOW() - INTERVAL '7 days')
+            OR
+            (t.status = 'cloturee' AND t.closed_at >= NOW() - INTERVAL '7 days')
+        )
+    """, "tasks_open_due_idx"),
+    ("admin_tasks_open", """
+        SELECT t.*, u.username
+        FROM tasks t
+        JOIN users u ON u.id = t.assigned_to
+        WHERE t.status='en_cours'
+        AND (t.created_at, t.id) < (NOW() - INTERVAL '3 days', 2147483647)
+        ORDER BY t.created_at DESC, t.id DESC
+        LIMIT 51
+    """, "tasks_open_created_idx"),
+    ("admin_tasks_closed", """
+        SELECT t.*, u.username
+        FROM tasks t
+        JOIN users u ON u.id = t.assigned_to
+        WHERE t.status='cloturee'
+        AND (t.closed_at, t.id) < (NOW() - INTERVAL '300 days', 2147483647)
+        ORDER BY t.closed_at DESC, t.id DESC
+        LIMIT 51
+    """, "tasks_closed_at_idx"),
+    ("global_kpis_line", """
+        SELECT COUNT(*), COUNT(*) FILTER (WHERE status='cloturee')
+        FROM tasks
+        WHERE line = %(line)s
+        AND machine = 'Machine 7'
+        AND created_at >= (NOW() - INTERVAL '30 days')::date
+    """, "tasks_line_machine_created_idx"),
+    ("global_kpis_period", """
+        SELECT COUNT(*), COUNT(*) FILTER (WHERE status='cloturee')
+        FROM tasks
+        WHERE created_at >= (NOW() - INTERVAL '30 days')::date
+    """, "tasks_created_at_idx"),
+    ("operator_delta_etag", """
+        SELECT MAX(updated_at) FROM tasks
+        WHERE assigned_to = %(user_id)s
+    """, "tasks_assignee_updated_idx"),
+    ("operator_delta", """
+        SELECT * FROM tasks
+        WHERE assigned_to = %(user_id)s
+        AND updated_at > NOW() - INTERVAL '1 hour'
+        ORDER BY updated_at, id
+        LIMIT 500
+    """, "tasks_assignee_updated_idx"),
+    ("overdue", """
+        SELECT line,
+               COUNT(*) FILTER (WHERE due_at < NOW()) AS overdue,
+               COUNT(*) FILTER (WHERE due_at >= NOW()) AS at_risk
+        FROM tasks
+        WHERE status = 'en_cours'
+        AND due_at < NOW() + INTERVAL '24 hours'
+        GROUP BY line
+    """, "tasks_open_due_idx"),
+    ("overdue_machine", """
+        SELECT line, machine,
+               COUNT(*) FILTER (WHERE due_at < NOW()) AS overdue,
+               COUNT(*) FILTER (WHERE due_at >= NOW()) AS at_risk
+        FROM tasks
+        WHERE status = 'en_cours'
+        AND due_at < NOW() + INTERVAL '24 hours'
+        AND line = %(line)s AND machine = 'Machine 7'
+        GROUP BY line, machine
+    """, "tasks_open_line_machine_due_idx"),
+    ("overdue_team", """
+        SELECT assigned_to,
+               COUNT(*) FILTER (WHERE due_at < NOW()) AS overdue,
+               COUNT(*) FILTER (WHERE due_at >= NOW()) AS at_risk
+        FROM tasks
+        WHERE status = 'en_cours'
+        AND due_at < NOW() + INTERVAL '24 hours'
+        AND assigned_to IN (SELECT id FROM users WHERE team_leader_id = %(leader_id)s)
+        GROUP BY assigned_to
+    """, "tasks_open_due_idx"),
+]
+
+_CHECK_SCHEMA = "pmp_index_check"
+
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def check_hot_indexes(rows=1_000_000):
+    """Génère `rows` tâches synthétiques et vérifie le plan des requêtes chaudes.
+
+    Tout est fait dans une transaction annulée à la fin : rien ne reste en base.
+    """
+    conn = get_db()
+    cur = conn.cursor()
+    results = []
+    try:
+        cur.execute(f"CREATE SCHEMA {_CHECK_SCHEMA}")
+        cur.execute(f"SET LOCAL search_path = {_CHECK_SCHEMA}")
+        for table in ("users", "tasks", "feedback_form", "machine_anomalies"):
+            cur.execute(f"""
+                CREATE TABLE {table}
+                (LIKE public.{table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)
+            """)
+            cur.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id)")
+
+        # 25 chefs d'équipe, 500 opérateurs
+        cur.execute("""
+            INSERT INTO users(id, username, password_hash, role, prod_line, team_leader_id)
+            SELECT 1000 + g, 'leader' || g, '-', 'team_leader', NULL, NULL
+            FROM generate_series(1, 25) g
+        """)
+        cur.execute("""
+            INSERT INTO users(id, username, password_hash, role, prod_line, team_leader_id)
+            SELECT g, 'op' || g, '-', 'operator',
+                   (ARRAY['CSD PET3','Water PET4','CSD PET8'])[1 + g % 3],
+                   1001 + g % 25
+            FROM generate_series(1, 500) g
+        """)
+        # une tâche par minute : les 3 % les plus récentes ouvertes,
+        # les 2 % suivantes clôturées mais pas encore confirmées
+        cur.execute("""
+            INSERT INTO tasks(
+                id, line, machine, description, assigned_to, status, points,
+                frequency, created_at, closed_at, validated_by_leader, updated_at
+            )
+            SELECT
+                g,
+                (ARRAY['CSD PET3','Water PET4','CSD PET8'])[1 + g %% 3],
+                'Machine ' || (g %% 40),
+                'Tâche ' || g,
+                1 + g %% 500,
+                CASE WHEN g > %(rows)s * 0.97 THEN 'en_cours' ELSE 'cloturee' END,
+                3,
+                (ARRAY['Quotidien','Hebdommadaire','Mensuel'])[1 + g %% 3],
+                NOW() - (%(rows)s - g) * INTERVAL '1 minute',
+                CASE WHEN g > %(rows)s * 0.97 THEN NULL
+                     ELSE NOW() - (%(rows)s - g) * INTERVAL '1 minute' + INTERVAL '2 hours' END,
+                g <= %(rows)s * 0.95,
+                NOW() - (%(rows)s - g) * INTERVAL '1 minute'
+                    + CASE WHEN g > %(rows)s * 0.97 THEN INTERVAL '0' ELSE INTERVAL '2 hours' END
+            FROM generate_series(1, %(rows)s) g
+        """, {"rows": rows})
+
+        for name, table, definition in (
+            HOT_INDEXES + FREQUENCY_INDEXES + DUE_INDEXES + DELTA_INDEXES + DASHBOARD_INDEXES
+        ):
+            if name in SUPERSEDED_INDEXES:
+                continue
+            cur.execute(f"CREATE INDEX {name} ON {table} {definition}")
+        cur.execute("ANALYZE users")
+        cur.execute("ANALYZE tasks")
+
+        params = {"user_id": 42, "leader_id": 1003, "line": "CSD PET3"}
+        for label, sql, expected in HOT_QUERIES:
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cur.fetchone()["QUERY PLAN"][0]["Plan"]
+            used = set()
+            seq_scans = set()
+            for node in _plan_nodes(plan):
+                if node.get("Index Name"):
+                    used.add(node["Index Name"])
+                if node.get("Node Type") == "Seq Scan":
+                    seq_scans.add(node.get("Relation Name"))
+            ok = expected in used and "tasks" not in seq_scans
+            results.append({
+                "query": label,
+                "ok": ok,
+                "expected": expected,
+                "used": sorted(used),
+                "seq_scans": sorted(seq_scans),
+            })
+    finally:
+        conn.rollback()
+        cur.close()
+        conn.close()
+
+    return results
+
+
+@app.cli.command("check-indexes")
+@click.option("--rows", type=int, default=1_000_000, help="Nombre de tâches synthétiques.")
+def check_indexes_command(rows):
+    """Vérifie par EXPLAIN que les requêtes chaudes utilisent leurs index."""
+    results = check_hot_indexes(rows)
+    for r in results:
+        mark = "OK " if r["ok"] else "ERR"
+        click.echo(
+            f"{mark} {r['query']:<24} attendu={r['expected']} index={','.join(r['used']) or '-'}"
+            f" seq_scan={','.join(r['seq_scans']) or '-'}"
+        )
+    if not all(r["ok"] for r in results):
+        raise SystemExit(1)
+
 
 # IMPORTANT pour Render
-init_db()
+ensure_schema()
 
 # -------------------------------------------------------
-# LECTURE EXCEL (INCHANGÉE)
+# LECTURE EXCEL (CACHE PAR MTIME)
 # -------------------------------------------------------
-def load_task_templates():
-    if not os.path.exists(EXCEL_PATH):
-        return [], [], {}, [], []
+# Le classeur n'est relu que si son chemin, sa date de modification ou sa
+# taille changent (append_task_to_excel, remplacement du fichier, ...).
+_templates_lock = threading.Lock()
+_templates_cache = {"key": None, "value": None}
+_templates_stats = {"hits": 0, "misses": 0, "reloads": 0}
+
 
-    df = pd.read_excel(EXCEL_PATH, sheet_name=EXCEL_SHEET)
+def _excel_cache_key(path):
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+def _parse_task_templates(path):
+    df = pd.read_excel(path, sheet_name=EXCEL_SHEET)
 
     df = df.rename(columns={
         "Line": "Ligne",
@@ -190,40 +1227,330 @@ def load_task_templates():
 
     return records, lignes, machines_par_ligne, intervenants, frequences
 
+
+def _load_excel_templates():
+    try:
+        key = _excel_cache_key(EXCEL_PATH)
+    except FileNotFoundError:
+        return None, ([], [], {}, [], [])
+
+    with _templates_lock:
+        if _templates_cache["key"] == key:
+            _templates_stats["hits"] += 1
+            return key, _templates_cache["value"]
+
+        _templates_stats["misses"] += 1
+        if _templates_cache["key"] is not None:
+            _templates_stats["reloads"] += 1
+
+        value = _parse_task_templates(EXCEL_PATH)
+        _templates_cache["key"] = key
+        _templates_cache["value"] = value
+        return key, value
+
+
+def template_cache_stats():
+    with _templates_lock:
+        stats = dict(_templates_stats)
+        key = _templates_cache["key"]
+    stats["cached"] = key is not None
+    stats["mtime_ns"] = key[1] if key else None
+    stats["size"] = key[2] if key else None
+    stats["db_version"] = _templates_db_cache["version"]
+    return stats
+
+
+# -------------------------------------------------------
+# PLAN PMP EN BASE (table task_templates)
+# -------------------------------------------------------
+# Le classeur reste le fichier de saisie, mais les pages et la génération
+# PMP lisent la table task_templates. L'import ne touche que les lignes
+# réellement ajoutées, modifiées ou supprimées.
+_TEMPLATE_FIELDS = ("Ligne", "Machine", "Description", "Frequence", "Intervenant", "Documentation")
+
+_TEMPLATE_SELECT = """
+    SELECT
+        line          AS "Ligne",
+        machine       AS "Machine",
+        description   AS "Description",
+        frequency     AS "Frequence",
+        frequency_code AS "CodeFrequence",
+        intervenant   AS "Intervenant",
+        documentation AS "Documentation",
+        source_key    AS "Cle"
+    FROM task_templates
+"""
+
+_templates_db_cache = {"version": None, "value": None, "synced_key": None}
+
+
+def _template_rows(records):
+    """Construit (source_key, row_hash, valeurs) pour chaque ligne du plan.
+
+    La clé identifie une tâche (ligne, machine, description, rang du
+    doublon) ; le hash couvre tous les champs pour détecter les modifications.
+    """
+    seen = defaultdict(int)
+    rows = []
+    for r in records:
+        values = tuple(str(r.get(f, "")) for f in _TEMPLATE_FIELDS)
+        ident = values[:3]
+        seen[ident] += 1
+        source_key = hashlib.sha1(
+            "\x1f".join(ident + (str(seen[ident]),)).encode("utf-8")
+        ).hexdigest()
+        row_hash = hashlib.sha1("\x1f".join(values).encode("utf-8")).hexdigest()
+        rows.append((source_key, row_hash) + values)
+    return rows
+
+
+def import_task_templates(path=None, force=False):
+    """Synchronise task_templates avec le classeur Excel.
+
+    Retourne le nombre de lignes insérées / mises à jour / supprimées.
+    Un verrou consultatif sérialise les imports entre workers.
+    """
+    path = path or EXCEL_PATH
+    if path == EXCEL_PATH:
+        key, (records, _, _, _, _) = _load_excel_templates()
+    else:
+        key = _excel_cache_key(path)
+        records = _parse_task_templates(path)[0]
+
+    result = {"inserted": 0, "updated": 0, "deleted": 0, "skipped": False}
+    if key is None:
+        result["skipped"] = True
+        return result
+
+    db = get_db()
+    c = db.cursor()
+    c.execute("SELECT pg_advisory_xact_lock(hashtext('task_templates_import'))")
+
+    c.execute("""
+        SELECT source_path, source_mtime_ns, source_size
+        FROM task_template_imports
+        ORDER BY id DESC
+        LIMIT 1
+    """)
+    last = c.fetchone()
+    if not force and last and (last["source_path"], last["source_mtime_ns"], last["source_size"]) == key:
+        db.rollback()
+        db.close()
+        result["skipped"] = True
+        return result
+
+    rows = _template_rows(records)
+    c.execute("SELECT source_key, row_hash FROM task_templates")
+    existing = {r["source_key"]: r["row_hash"] for r in c.fetchall()}
+
+    changed = [r for r in rows if existing.get(r[0]) != r[1]]
+    wanted = {r[0] for r in rows}
+    removed = [k for k in existing if k not in wanted]
+
+    if changed:
+        psycopg2.extras.execute_values(c, """
+            INSERT INTO task_templates(
+                source_key, row_hash, line, machine, description,
+                frequency, intervenant, documentation
+            )
+            VALUES %s
+            ON CONFLICT (source_key) DO UPDATE SET
+                row_hash      = EXCLUDED.row_hash,
+                frequency     = EXCLUDED.frequency,
+                intervenant   = EXCLUDED.intervenant,
+                documentation = EXCLUDED.documentation,
+                imported_at   = CURRENT_TIMESTAMP
+        """, changed)
+    if removed:
+        c.execute("DELETE FROM task_templates WHERE source_key = ANY(%s)", (removed,))
+
+    result["updated"] = sum(1 for r in changed if r[0] in existing)
+    result["inserted"] = len(changed) - result["updated"]
+    result["deleted"] = len(removed)
+
+    c.execute("""
+        INSERT INTO task_template_imports(
+            source_path, source_mtime_ns, source_size, inserted, updated, deleted
+        )
+        VALUES (%s,%s,%s,%s,%s,%s)
+    """, key + (result["inserted"], result["updated"], result["deleted"]))
+
+    db.commit()
+    db.close()
+    return result
+
+
+def _sync_task_templates():
+    # import automatique quand le classeur a changé depuis la dernière vérification
+    try:
+        key = _excel_cache_key(EXCEL_PATH)
+    except FileNotFoundError:
+        return
+    if _templates_db_cache["synced_key"] == key:
+        return
+    import_task_templates()
+    _templates_db_cache["synced_key"] = key
+
+
+def query_task_templates(line=None, freq_codes=None, machine=None, lines=None):
+    _sync_task_templates()
+
+    where = []
+    params = []
+    if line:
+        where.append("line=%s")
+        params.append(line)
+    if lines:
+        where.append("line = ANY(%s)")
+        params.append(list(lines))
+    if machine:
+        where.append("machine=%s")
+        params.append(machine)
+    if freq_codes:
+        where.append("frequency_code = ANY(%s)")
+        params.append(list(freq_codes))
+
+    where_sql = "WHERE " + " AND ".join(where) if where else ""
+
+    db = get_db()
+    c = db.cursor()
+    c.execute(f"{_TEMPLATE_SELECT} {where_sql} ORDER BY id", params)
+    rows = c.fetchall()
+    db.close()
+    return rows
+
+
+def load_task_templates():
+    _sync_task_templates()
+
+    db = get_db()
+    c = db.cursor()
+    c.execute("SELECT COALESCE(MAX(id), 0) AS v FROM task_template_imports")
+    version = c.fetchone()["v"]
+
+    with _templates_lock:
+        if _templates_db_cache["version"] == version:
+            db.close()
+            return _templates_db_cache["value"]
+
+    c.execute(f"{_TEMPLATE_SELECT} ORDER BY id")
+    records = c.fetchall()
+    db.close()
+
+    lignes = sorted({r["Ligne"] for r in records if r["Ligne"]})
+
+    machines_par_ligne = {}
+    for r in records:
+        if r["Ligne"] and r["Machine"]:
+            machines_par_ligne.setdefault(r["Ligne"], set()).add(r["Machine"])
+
+    machines_par_ligne = {k: sorted(v) for k, v in machines_par_ligne.items()}
+    intervenants = sorted({r["Intervenant"] for r in records})
+    frequences = sorted({r["Frequence"] for r in records})
+
+    value = (records, lignes, machines_par_ligne, intervenants, frequences)
+    with _templates_lock:
+        _templates_db_cache["version"] = version
+        _templates_db_cache["value"] = value
+    return value
+
+
+@app.cli.command("import-templates")
+@click.option("--path", default=None, help="Classeur à importer (défaut : data/plan_pmp.xlsx).")
+@click.option("--force", is_flag=True, help="Réimporter même si le fichier n'a pas changé.")
+def import_templates_command(path, force):
+    """Importe le plan PMP Excel dans la table task_templates."""
+    result = import_task_templates(path, force=force)
+    if result["skipped"]:
+        click.echo("Plan PMP déjà à jour.")
+    else:
+        click.echo(
+            f"{result['inserted']} ajoutées, {result['updated']} modifiées, "
+            f"{result['deleted']} supprimées."
+        )
+
 # -------------------------------------------------------
 # AUTH HELPERS (LOGIQUE IDENTIQUE)
 # -------------------------------------------------------
+# Le rôle est gardé dans la session signée avec la version de l'utilisateur
+# (users.version, incrémentée à chaque modification par l'admin). Tant que
+# le tampon a moins de AUTH_STAMP_TTL secondes, les contrôles de rôle ne
+# touchent pas la base ; ensuite seule la version est relue.
+AUTH_STAMP_TTL = int(os.environ.get("AUTH_STAMP_TTL", "60"))
+
+
+def _issue_auth_stamp(u):
+    session["user_id"] = u["id"]
+    session["role"] = u["role"]
+    session["auth"] = {"v": u["version"], "at": int(time.time())}
+
+
 def current_user():
     if "user_id" not in session:
         return None
-    db = get_db()
-    c = db.cursor()
-    c.execute("SELECT * FROM users WHERE id=%s", (session["user_id"],))
-    u = c.fetchone()
-    db.close()
-    return u
+    # une seule lecture de users par requête
+    if "current_user" not in g:
+        db = get_db()
+        c = db.cursor()
+        c.execute("SELECT * FROM users WHERE id=%s", (session["user_id"],))
+        g.current_user = c.fetchone()
+        db.close()
+        if g.current_user is None and g.get("login_checked"):
+            # utilisateur supprimé depuis l'émission du tampon de session
+            session.clear()
+            abort(redirect(url_for("login")))
+    return g.current_user
+
+
+def session_role():
+    if "user_id" not in session:
+        return None
+
+    stamp = session.get("auth")
+    if stamp and time.time() - stamp["at"] < AUTH_STAMP_TTL:
+        return session.get("role")
+
+    if stamp and "current_user" not in g:
+        db = get_db()
+        c = db.cursor()
+        c.execute("SELECT version FROM users WHERE id=%s", (session["user_id"],))
+        row = c.fetchone()
+        db.close()
+        if row and row["version"] == stamp["v"]:
+            session["auth"] = {"v": stamp["v"], "at": int(time.time())}
+            return session.get("role")
+
+    # tampon absent ou utilisateur modifié : rechargement complet
+    u = current_user()
+    if not u:
+        session.clear()
+        return None
+    _issue_auth_stamp(u)
+    return u["role"]
+
 
 def login_required(role=None):
     def decorator(f):
         from functools import wraps
         @wraps(f)
         def wrapper(*args, **kwargs):
-            u = current_user()
+            user_role = session_role()
 
-            if not u:
+            if not user_role:
                 return redirect(url_for("login"))
+            g.login_checked = True
 
             # Gestion multi rôles
             if role:
                 if isinstance(role, (list, tuple)):
-                    if u["role"] not in role:
+                    if user_role not in role:
                         return redirect(
-                            url_for("admin_dashboard" if u["role"]=="admin" else "operator_dashboard")
+                            url_for("admin_dashboard" if user_role=="admin" else "operator_dashboard")
                         )
                 else:
-                    if u["role"] != role:
+                    if user_role != role:
                         return redirect(
-                            url_for("admin_dashboard" if u["role"]=="admin" else "operator_dashboard")
+                            url_for("admin_dashboard" if user_role=="admin" else "operator_dashboard")
                         )
 
             return f(*args, **kwargs)
@@ -280,6 +1607,16 @@ def _role_from_intervenant(x):
 # -------------------------------------------------------
 # KPI (LOGIQUE IDENTIQUE)
 # -------------------------------------------------------
+def _append_date_range(where, params, column, start_date, end_date):
+    # bornes sargables : column >= début AND column < fin + 1 jour
+    if start_date:
+        where.append(f"{column} >= %s::date")
+        params.append(start_date)
+    if end_date:
+        where.append(f"{column} < %s::date + 1")
+        params.append(end_date)
+
+
 def get_global_kpis(filters=None):
     if filters is None:
         filters = {}
@@ -301,58 +1638,48 @@ def get_global_kpis(filters=None):
     if machine:
         where.append("machine=%s")
         params.append(machine)
-    if start_date:
-        where.append("DATE(created_at)>= %s")
-        params.append(start_date)
-    if end_date:
-        where.append("DATE(created_at)<= %s")
-        params.append(end_date)
+    _append_date_range(where, params, "created_at", start_date, end_date)
 
     where_sql = "WHERE " + " AND ".join(where) if where else ""
 
-    # -------- TOTAL TÂCHES ----------
-    c.execute(f"SELECT COUNT(*) n FROM tasks {where_sql}", params)
-    total = c.fetchone()["n"]
+    # -------- TOTAL, CLÔTURÉES, SCORE + AJUSTEMENT ADMIN (1 requête) ----------
+    c.execute(f"""
+        SELECT
+            k.total,
+            k.done,
+            k.score,
+            s.taux_offset,
+            s.score_offset
+        FROM (
+            SELECT
+                COUNT(*) AS total,
+                COUNT(*) FILTER (WHERE status='cloturee') AS done,
+                COALESCE(SUM(points) FILTER (WHERE status='cloturee'),0) AS score
+            FROM tasks
+            {where_sql}
+        ) k
+        LEFT JOIN LATERAL (
+            SELECT taux_offset, score_offset
+            FROM kpi_settings
+            LIMIT 1
+        ) s ON TRUE
+    """, params)
+    row = c.fetchone()
+    db.close()
 
-    # -------- TÂCHES CLÔTURÉES ----------
-    if where_sql:
-        c.execute(f"""
-            SELECT COUNT(*) n
-            FROM tasks {where_sql} AND status='cloturee'
-        """, params)
-    else:
-        c.execute("SELECT COUNT(*) n FROM tasks WHERE status='cloturee'")
-    done = c.fetchone()["n"]
+    total = row["total"]
+    done = row["done"]
 
-    # -------- TAUX RÉEL ----------
+    # -------- TAUX / SCORE RÉELS ----------
     taux = round(done * 100 / total) if total else 0
-
-    # -------- SCORE RÉEL ----------
-    if where_sql:
-        c.execute(f"""
-            SELECT COALESCE(SUM(points),0) s
-            FROM tasks {where_sql} AND status='cloturee'
-        """, params)
-    else:
-        c.execute("""
-            SELECT COALESCE(SUM(points),0) s
-            FROM tasks WHERE status='cloturee'
-        """)
-    score = c.fetchone()["s"]
+    score = row["score"]
 
     # ====================================================
     # 🔧 AJUSTEMENT KPI (ADMIN)
     # ====================================================
-    c.execute("""
-        SELECT taux_offset, score_offset
-        FROM kpi_settings
-        LIMIT 1
-    """)
-    cfg = c.fetchone()
-
-    if cfg:
-        taux = max(0, min(100, taux + cfg["taux_offset"]))
-        score = score + cfg["score_offset"]
+    if row["taux_offset"] is not None:
+        taux = max(0, min(100, taux + row["taux_offset"]))
+        score = score + row["score_offset"]
 
     # -------- COULEUR SELON TAUX FINAL ----------
     if taux >= 80:
@@ -362,8 +1689,6 @@ def get_global_kpis(filters=None):
     else:
         color = "red"
 
-    db.close()
-
     return {
         "total_taches": total,
         "taches_realisees": done,
@@ -428,8 +1753,7 @@ def login():
         conn.close()
 
         if u and check_password_hash(u["password_hash"], password):
-            session["user_id"] = u["id"]
-            session["role"] = u["role"]
+            _issue_auth_stamp(u)
             return redirect(url_for("index"))
 
         return render_template("login.html", error="Nom ou mot de passe incorrect")
@@ -480,117 +1804,315 @@ def admin_settings():
         current_year=datetime.now().year
     )
 
-@app.route("/leader")
-@login_required(role="team_leader")
-def team_leader_dashboard():
-    return render_template("leader_menu.html")
+# -------------------------------------------------------
+# CHEF D'ÉQUIPE : file de revue (3 listes, une requête)
+# -------------------------------------------------------
+LEADER_BUCKET_LIMIT = 200
+LEADER_BUCKETS = ("open", "to_validate", "validated")
+
+
+def leader_review_queue(leader_id, limit=LEADER_BUCKET_LIMIT):
+    """Tâches de l'équipe réparties en open / to_validate / validated.
+
+    Une seule requête : chaque liste est limitée à `limit` lignes et son
+    total est retourné dans `counts`. Fenêtre : tâches ouvertes dues
+    depuis moins de 7 jours, tâches clôturées depuis moins de 7 jours.
+    """
+    db = get_db()
+    c = db.cursor()
+    c.execute("""
+        WITH q AS (
+            SELECT t.*, u.username,
+                CASE
+                    WHEN t.status = 'en_cours' THEN 'open'
+                    WHEN t.validated_by_leader THEN 'validated'
+                    ELSE 'to_validate'
+                END AS bucket
+            FROM users u
+            JOIN tasks t ON t.assigned_to = u.id
+            WHERE u.team_leader_id = %(leader_id)s
+            AND (
+                (t.status = 'en_cours' AND t.due_at >= NOW() - INTERVAL '7 days')
+                OR
+                (t.status = 'cloturee' AND t.closed_at >= NOW() - INTERVAL '7 days')
+            )
+        ),
+        ranked AS (
+            SELECT q.*,
+                ROW_NUMBER() OVER (
+                    PARTITION BY bucket
+                    ORDER BY CASE WHEN bucket = 'open' THEN due_at END, closed_at DESC, id DESC
+                ) AS rn,
+                COUNT(*) OVER (PARTITION BY bucket) AS bucket_count
+            FROM q
+        )
+        SELECT * FROM ranked
+        WHERE rn <= %(limit)s
+        ORDER BY bucket, rn
+    """, {"leader_id": leader_id, "limit": max(limit, 1)})
+    rows = c.fetchall()
+    db.close()
+
+    queue = {b: [] for b in LEADER_BUCKETS}
+    counts = {b: 0 for b in LEADER_BUCKETS}
+    for r in rows:
+        counts[r["bucket"]] = r["bucket_count"]
+        if r["rn"] <= limit:
+            queue[r["bucket"]].append(r)
+    queue["counts"] = counts
+    return queue
+
+
+def _validate_team_tasks(c, leader_id, task_ids):
+    """Confirme en un UPDATE les clôtures de l'équipe ; retourne les id confirmés."""
+    c.execute("""
+        UPDATE tasks t
+        SET validated_by_leader = TRUE
+        FROM users u
+        WHERE u.id = t.assigned_to
+        AND u.team_leader_id = %s
+        AND t.id = ANY(%s)
+        AND t.status = 'cloturee'
+        AND t.validated_by_leader IS NOT TRUE
+        RETURNING t.id
+    """, (leader_id, task_ids))
+    return [r["id"] for r in c.fetchall()]
+
+
+@app.route("/leader")
+@login_required(role="team_leader")
+def team_leader_dashboard():
+    counts = leader_review_queue(current_user()["id"], limit=0)["counts"]
+    return render_template("leader_menu.html", counts=counts)
+
+@app.route("/leader/tasks/open")
+@login_required(role="team_leader")
+def leader_tasks_open():
+    queue = leader_review_queue(current_user()["id"])
+    return render_template(
+        "leader_tasks_open.html",
+        tasks=queue["open"],
+        counts=queue["counts"],
+        now=datetime.now()
+    )
+
+
+@app.route("/leader/tasks/validate")
+@login_required(role="team_leader")
+def leader_tasks_validate():
+    queue = leader_review_queue(current_user()["id"])
+    return render_template(
+        "leader_tasks_validate.html",
+        tasks=queue["to_validate"],
+        counts=queue["counts"],
+        now=datetime.now()
+    )
+
+
+@app.route("/leader/tasks/validated")
+@login_required(role="team_leader")
+def leader_tasks_validated():
+    queue = leader_review_queue(current_user()["id"])
+    return render_template(
+        "leader_tasks_validated.html",
+        tasks=queue["validated"],
+        counts=queue["counts"]
+    )
+
 
-@app.route("/leader/tasks/open")
-@login_required(role="team_leader")
-def leader_tasks_open():
+def _json_task_ids(data, key="task_ids"):
+    """Liste d'identifiants d'un corps JSON ; TypeError / ValueError sinon.
 
-    user = current_user()
-    db = get_db()
-    c = db.cursor()
+    Une chaîne n'est pas acceptée : "15" serait lue comme les tâches 1 et 5.
+    """
+    if not isinstance(data, dict):
+        raise TypeError(data)
+    raw = data.get(key, [])
+    if not isinstance(raw, list):
+        raise TypeError(raw)
+    if any(isinstance(t, (bool, float)) for t in raw):
+        raise TypeError(raw)
+    return [int(t) for t in raw]
 
-    c.execute("""   
-        SELECT t.*, u.username
-        FROM tasks t
-        JOIN users u ON u.id = t.assigned_to
-        WHERE u.team_leader_id = %s
-        AND t.status = 'en_cours'
-        AND t.created_at >= NOW() - INTERVAL '7 days'
-        ORDER BY t.created_at DESC
-    """, (user["id"],))
 
-    tasks = c.fetchall()
-    db.close()
+@app.route("/leader/validate", methods=["POST"])
+@login_required(role="team_leader")
+def leader_validate_tasks():
+    # formulaire (cases task_ids) ou JSON {"task_ids": [...]}
+    try:
+        if request.is_json:
+            raw = _json_task_ids(request.get_json(silent=True))
+        else:
+            raw = request.form.getlist("task_ids")
+        task_ids = sorted({int(t) for t in raw})
+    except (TypeError, ValueError):
+        if request.is_json:
+            return jsonify({"error": "task_ids doit être une liste d'entiers"}), 400
+        flash("Sélection invalide.", "err")
+        return redirect(url_for("leader_tasks_validate"))
+
+    validated = []
+    if task_ids:
+        db = get_db()
+        c = db.cursor()
+        validated = _validate_team_tasks(c, current_user()["id"], task_ids)
+        db.commit()
+        db.close()
+
+    if request.is_json:
+        return jsonify({
+            "validated": validated,
+            "ignored": [t for t in task_ids if t not in set(validated)],
+        })
 
-    return render_template("leader_tasks_open.html", tasks=tasks)
+    if validated:
+        flash(f"{len(validated)} tâche(s) confirmée(s)", "ok")
+    else:
+        flash("Aucune tâche confirmée.", "err")
+    return redirect(url_for("leader_tasks_validate"))
+    
+# -------------------------------------------------------
+# PERFORMANCE OPÉRATEURS (vue matérialisée operator_daily_perf)
+# -------------------------------------------------------
+# La vue est rafraîchie en CONCURRENTLY (lectures non bloquées) toutes les
+# PERF_REFRESH_INTERVAL secondes par le processus planificateur : les pages
+# web ne déclenchent rien (un rafraîchissement relit toute la table tasks).
+PERF_REFRESH_INTERVAL = int(os.getenv("PERF_REFRESH_INTERVAL", "300"))
+PERF_REFRESH_LOCK_KEY = 7_340_003
+PERF_DEFAULT_DAYS = 30
 
+_perf_refresh = {"runs": 0, "last_at": None, "last_duration": None}
+_perf_refresh_lock = threading.Lock()
 
-@app.route("/leader/tasks/validate")
-@login_required(role="team_leader")
-def leader_tasks_validate():
 
-    user = current_user()
+def refresh_operator_perf():
+    """Rafraîchit operator_daily_perf ; False si un autre processus s'en charge."""
+    start = time.perf_counter()
     db = get_db()
     c = db.cursor()
+    try:
+        c.execute("SELECT pg_try_advisory_xact_lock(%s) AS ok", (PERF_REFRESH_LOCK_KEY,))
+        if not c.fetchone()["ok"]:
+            db.rollback()
+            return False
+        c.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY operator_daily_perf")
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print("❌ ERREUR RAFRAÎCHISSEMENT operator_daily_perf:", repr(e))
+        return False
+    finally:
+        db.close()
 
-    c.execute("""   
-        SELECT t.*, u.username
-        FROM tasks t
-        JOIN users u ON u.id = t.assigned_to
-        WHERE u.team_leader_id = %s
-        AND t.status = 'cloturee'
-        AND t.validated_by_leader = FALSE
-        AND t.created_at >= NOW() - INTERVAL '7 days'
-        ORDER BY t.closed_at DESC
-    """, (user["id"],))
+    with _perf_refresh_lock:
+        _perf_refresh["runs"] += 1
+        _perf_refresh["last_at"] = datetime.now().isoformat()
+        _perf_refresh["last_duration"] = round(time.perf_counter() - start, 3)
+    return True
 
-    tasks = c.fetchall()
-    db.close()
 
-    return render_template("leader_tasks_validate.html", tasks=tasks)
+def _perf_refresh_loop():
+    # fil du planificateur : rafraîchissement à intervalle fixe
+    while True:
+        refresh_operator_perf()
+        time.sleep(PERF_REFRESH_INTERVAL)
 
 
-@app.route("/leader/tasks/validated")
-@login_required(role="team_leader")
-def leader_tasks_validated():
+def perf_refresh_stats():
+    with _perf_refresh_lock:
+        return dict(_perf_refresh, interval=PERF_REFRESH_INTERVAL)
 
-    user = current_user()
-    db = get_db()
-    c = db.cursor()
 
-    c.execute("""
-        SELECT t.*, u.username
-        FROM tasks t
-        JOIN users u ON u.id = t.assigned_to
-        WHERE u.team_leader_id = %s
-        AND t.status = 'cloturee'
-        AND t.validated_by_leader = TRUE
-        AND t.created_at >= NOW() - INTERVAL '7 days'
-        ORDER BY t.closed_at DESC
-    """, (user["id"],))
+def _operator_perf(c, start_date, end_date, line):
+    where = []
+    params = []
+    _append_date_range(where, params, "p.day", start_date, end_date)
+    if line:
+        where.append("p.line=%s")
+        params.append(line)
+    where_sql = "WHERE " + " AND ".join(where) if where else ""
+
+    c.execute(f"""
+    SELECT
+        u.username,
+        p.line AS prod_line,
+        p.machine,
+        SUM(p.total_tasks) AS total_tasks,
+        SUM(p.completed_tasks) AS completed_tasks,
+        SUM(p.score) AS score,
+        ROUND(
+            SUM(p.completed_tasks) * 100.0
+            / NULLIF(SUM(p.total_tasks),0),
+        1) AS completion_rate
+    FROM operator_daily_perf p
+    JOIN users u ON u.id = p.user_id
+    {where_sql}
+    GROUP BY u.username, p.line, p.machine
+    ORDER BY completion_rate ASC
+    """, params)
+    return c.fetchall()
 
-    tasks = c.fetchall()
-    db.close()
 
-    return render_template("leader_tasks_validated.html", tasks=tasks)
-    
 @app.route("/admin/operator-performance")
 @login_required(role="admin")
 def operator_performance():
+    today = datetime.now().date()
+    if request.args:
+        start_date = (request.args.get("start_date") or "").strip()
+        end_date = (request.args.get("end_date") or "").strip()
+    else:
+        start_date = (today - timedelta(days=PERF_DEFAULT_DAYS)).isoformat()
+        end_date = today.isoformat()
+    line = (request.args.get("line") or "").strip()
+    compare_start = (request.args.get("compare_start") or "").strip()
+    compare_end = (request.args.get("compare_end") or "").strip()
 
     db = get_db()
     c = db.cursor()
 
-    c.execute("""
-    SELECT
-        u.username,
-        u.prod_line,
-        t.machine,
-        COUNT(t.id) AS total_tasks,
-        SUM(CASE WHEN t.status='cloturee' THEN 1 ELSE 0 END) AS completed_tasks,
-        ROUND(
-            SUM(CASE WHEN t.status='cloturee' THEN 1 ELSE 0 END) * 100.0
-            / NULLIF(COUNT(t.id),0),
-        1) AS completion_rate
-    FROM tasks t
-    JOIN users u ON u.id = t.assigned_to
-    GROUP BY u.username, u.prod_line, t.machine
-    ORDER BY completion_rate ASC
-    """)
-
-    rows = c.fetchall()
+    rows = _operator_perf(c, start_date, end_date, line)
+
+    # période de comparaison : taux précédent et écart par opérateur / machine
+    if compare_start or compare_end:
+        previous = {
+            (r["username"], r["prod_line"], r["machine"]): r["completion_rate"]
+            for r in _operator_perf(c, compare_start, compare_end, line)
+        }
+        for r in rows:
+            prev = previous.get((r["username"], r["prod_line"], r["machine"]))
+            r["previous_rate"] = prev
+            r["delta"] = (
+                r["completion_rate"] - prev
+                if prev is not None and r["completion_rate"] is not None else None
+            )
 
     db.close()
 
+    _, lignes, _, _, _ = load_task_templates()
+
     return render_template(
         "admin_operator_performance.html",
-        rows=rows
+        rows=rows,
+        lignes=lignes,
+        filters={
+            "start_date": start_date,
+            "end_date": end_date,
+            "line": line,
+            "compare_start": compare_start,
+            "compare_end": compare_end,
+        },
+        compare=bool(compare_start or compare_end)
     )
 
+
+@app.cli.command("refresh-performance")
+def refresh_performance_command():
+    """Rafraîchit la vue matérialisée operator_daily_perf."""
+    if refresh_operator_perf():
+        click.echo(f"✅ operator_daily_perf rafraîchie en {_perf_refresh['last_duration']} s")
+    else:
+        click.echo("⚠️ Rafraîchissement non effectué (en cours ailleurs ou erreur).")
+
 @app.route("/admin/settings/user/delete/<int:user_id>", methods=["POST"])
 @login_required(role="admin")
 def admin_delete_user(user_id):
@@ -641,10 +2163,8 @@ def report_anomaly():
     conn = get_db()
     cur = conn.cursor()
 
-    import pandas as pd
-    df = pd.read_excel(EXCEL_PATH)   # chemin Excel actuel
-    lines = sorted(df["Line"].dropna().unique())
-    machines = sorted(df["EQUIPEMENT"].dropna().unique())
+    _, lines, machines_par_ligne, _, _ = load_task_templates()
+    machines = sorted({m for ms in machines_par_ligne.values() for m in ms})
 
     if request.method == "POST":
         line = request.form["Line"]
@@ -685,7 +2205,7 @@ def admin_change_user_password():
 
     cur.execute("""
         UPDATE users
-        SET password_hash=%s
+        SET password_hash=%s, version=version+1
         WHERE id=%s
     """, (generate_password_hash(new_password), user_id))
 
@@ -701,7 +2221,12 @@ def admin_delete_task(task_id):
     conn = get_db()
     cur = conn.cursor()
 
-    cur.execute("DELETE FROM tasks WHERE id=%s", (task_id,))
+    cur.execute("""
+        DELETE FROM tasks
+        WHERE id=%s
+        RETURNING assigned_to, status, points
+    """, (task_id,))
+    _apply_user_stats(cur, cur.fetchall(), sign=-1)
     conn.commit()
 
     cur.close()
@@ -778,7 +2303,7 @@ def admin_assign_team():
 
         c.execute("""
             UPDATE users
-            SET team_leader_id=%s
+            SET team_leader_id=%s, version=version+1
             WHERE id=%s
         """,(leader_id, op))
 
@@ -920,217 +2445,548 @@ from datetime import datetime
 from collections import defaultdict
 from psycopg2.extras import RealDictCursor
 
-def _auto_assign_pmp(line: str, freq_prefix: str):
-    try:
-        print(">>> AUTO ASSIGN PMP STARTED:", line, freq_prefix)
-
-        records, _, _, _, _ = load_task_templates()
-        freq_prefix = freq_prefix.lower()
-
-        r_filtered = [
-            r for r in records
-            if r.get("Ligne") == line
-            and freq_prefix in str(r.get("Frequence", "")).lower()
-        ]
+# -------------------------------------------------------
+# COMPTEURS PAR UTILISATEUR (user_stats)
+# -------------------------------------------------------
+def _apply_user_stats(c, tasks, sign=1):
+    """Reporte dans user_stats des tâches créées (sign=1) ou retirées (sign=-1).
 
-        if not r_filtered:
-            print("⚠️ Aucun template PMP trouvé")
-            return 0
+    `tasks` : lignes avec assigned_to, status, points (et closed_at). Un seul
+    upsert, utilisateurs triés pour éviter les interblocages. Pas de commit :
+    l'appelant garde la main sur la transaction.
+    """
+    deltas = {}
+    for t in tasks:
+        if t["assigned_to"] is None:
+            continue
+        d = deltas.setdefault(t["assigned_to"], [0, 0, 0, None])
+        if t["status"] == "cloturee":
+            d[1] += sign
+            d[2] += sign * (t["points"] or 0)
+            if sign > 0 and t.get("closed_at"):
+                d[3] = max(d[3], t["closed_at"]) if d[3] else t["closed_at"]
+        else:
+            d[0] += sign
+    if not deltas:
+        return
+    psycopg2.extras.execute_values(c, """
+        INSERT INTO user_stats(user_id, open_count, closed_count, score, last_closed_at)
+        VALUES %s
+        ON CONFLICT (user_id) DO UPDATE SET
+            open_count     = user_stats.open_count + EXCLUDED.open_count,
+            closed_count   = user_stats.closed_count + EXCLUDED.closed_count,
+            score          = user_stats.score + EXCLUDED.score,
+            last_closed_at = GREATEST(user_stats.last_closed_at, EXCLUDED.last_closed_at),
+            updated_at     = CURRENT_TIMESTAMP
+    """, [(uid, *d) for uid, d in sorted(deltas.items())],
+        template="(%s, %s, %s, %s, %s::timestamp)")
+
+
+def _close_user_stats(c, closed):
+    """Clôtures : une tâche passe d'ouverte à clôturée pour son assigné."""
+    _apply_user_stats(c, [dict(t, status="en_cours") for t in closed], sign=-1)
+    _apply_user_stats(c, [dict(t, status="cloturee") for t in closed])
+
+
+def reconcile_user_stats(fix=False):
+    """Compare user_stats aux tâches ; avec `fix`, réécrit les lignes en écart.
+
+    Retourne la liste des écarts (valeurs stockées / attendues). En
+    correction, la table est verrouillée contre les mises à jour
+    concurrentes le temps du recalcul.
+    """
+    db = get_db()
+    c = db.cursor()
+    try:
+        if fix:
+            c.execute("LOCK TABLE user_stats IN SHARE ROW EXCLUSIVE MODE")
+        c.execute(f"""
+            SELECT
+                COALESCE(s.user_id, e.user_id) AS user_id,
+                s.open_count, s.closed_count, s.score, s.last_closed_at,
+                COALESCE(e.open_count, 0) AS expected_open_count,
+                COALESCE(e.closed_count, 0) AS expected_closed_count,
+                COALESCE(e.score, 0) AS expected_score,
+                e.last_closed_at AS expected_last_closed_at
+            FROM user_stats s
+            FULL JOIN ({_USER_STATS_FROM_TASKS}) e ON e.user_id = s.user_id
+            WHERE (s.open_count, s.closed_count, s.score, s.last_closed_at)
+                IS DISTINCT FROM
+                (COALESCE(e.open_count, 0), COALESCE(e.closed_count, 0),
+                 COALESCE(e.score, 0), e.last_closed_at)
+            ORDER BY 1
+        """)
+        drift = c.fetchall()
+
+        if fix and drift:
+            psycopg2.extras.execute_values(c, """
+                INSERT INTO user_stats(user_id, open_count, closed_count, score, last_closed_at)
+                VALUES %s
+                ON CONFLICT (user_id) DO UPDATE SET
+                    open_count     = EXCLUDED.open_count,
+                    closed_count   = EXCLUDED.closed_count,
+                    score          = EXCLUDED.score,
+                    last_closed_at = EXCLUDED.last_closed_at,
+                    updated_at     = CURRENT_TIMESTAMP
+            """, [
+                (d["user_id"], d["expected_open_count"], d["expected_closed_count"],
+                 d["expected_score"], d["expected_last_closed_at"])
+                for d in drift
+            ], template="(%s, %s, %s, %s, %s::timestamp)")
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    return drift
+
+
+@app.cli.command("reconcile-stats")
+@click.option("--fix", is_flag=True, help="Corriger les écarts trouvés.")
+def reconcile_stats_command(fix):
+    """Vérifie les compteurs user_stats par rapport aux tâches."""
+    drift = reconcile_user_stats(fix=fix)
+    for d in drift:
+        click.echo(
+            f"user {d['user_id']} : ouvertes {d['open_count']}→{d['expected_open_count']}, "
+            f"clôturées {d['closed_count']}→{d['expected_closed_count']}, "
+            f"score {d['score']}→{d['expected_score']}"
+        )
+    if not drift:
+        click.echo("✅ user_stats cohérent avec les tâches.")
+    else:
+        click.echo(f"{len(drift)} écart(s) {'corrigé(s)' if fix else 'détecté(s)'}.")
 
-        by_machine_role = defaultdict(list)
-        for r in r_filtered:
-            role = _role_from_intervenant(r.get("Intervenant"))
-            if not role:
-                continue
-            by_machine_role[(r.get("Machine"), role)].append(r)
 
-        db = get_db()
-        c = db.cursor(cursor_factory=RealDictCursor)  # ✅ POSTGRESQL
+TASK_INSERT_COLUMNS = (
+    "line", "machine", "description", "assigned_to",
+    "status", "points", "frequency", "documentation", "created_at",
+)
 
-        c.execute("""
-            SELECT id, role, prod_line, machine_assigned
-            FROM users
-            WHERE prod_line=%s
-        """, (line,))
-        users = c.fetchall()
 
-        if not users:
-            print("⚠️ Aucun utilisateur pour la ligne", line)
-            db.close()
-            return 0
+def _insert_tasks(c, rows, columns=TASK_INSERT_COLUMNS, on_conflict=""):
+    """Insère les tâches en un seul INSERT multi-lignes ; retourne leurs id.
 
-        users_by_machine_role = defaultdict(list)
-        for u in users:
-            machines = []
-            if u["machine_assigned"]:
-                machines = u["machine_assigned"].split("|")
+    `rows` suit l'ordre de `columns`. Avec `on_conflict` (ex. DO NOTHING),
+    seules les lignes réellement insérées sont retournées et comptées dans
+    user_stats. Pas de commit : l'appelant garde la main sur la transaction.
+    """
+    if not rows:
+        return []
+    inserted = psycopg2.extras.execute_values(c, f"""
+        INSERT INTO tasks ({", ".join(columns)})
+        VALUES %s
+        {on_conflict}
+        RETURNING id, assigned_to, status, points, closed_at
+    """, rows, page_size=1000, fetch=True)
+    _apply_user_stats(c, inserted)
+    return [r["id"] for r in inserted]
 
-            for m in machines:
-                users_by_machine_role[(m, u["role"])].append(u["id"])
 
-        task_count = defaultdict(int)
-        created = 0
-        now = datetime.now().isoformat()
+# -------------------------------------------------------
+# ÉQUILIBRAGE DE CHARGE (tas de priorité)
+# -------------------------------------------------------
+def _open_workload(c, user_ids):
+    """Charge ouverte par utilisateur : {user_id: [points, tâches]}."""
+    workload = {u: [0, 0] for u in user_ids}
+    if not user_ids:
+        return workload
+    c.execute("""
+        SELECT assigned_to, COUNT(*) AS n, COALESCE(SUM(points),0) AS pts
+        FROM tasks
+        WHERE status='en_cours'
+        AND assigned_to = ANY(%s)
+        GROUP BY assigned_to
+    """, (list(user_ids),))
+    for row in c.fetchall():
+        workload[row["assigned_to"]] = [row["pts"], row["n"]]
+    return workload
 
-        for (machine, role), tasks in by_machine_role.items():
-            user_ids = users_by_machine_role.get((machine, role), [])
 
-            if not user_ids:
-                print(f"⚠️ Aucun opérateur pour {machine} ({role})")
-                continue
+def _balanced_assignments(by_group, users_by_group, workload, points=3):
+    """Affecte chaque tâche à l'utilisateur le moins chargé de son groupe.
 
-            for r in tasks:
-                chosen = min(user_ids, key=lambda u: task_count[u])
+    La charge (points, nombre de tâches) part de `workload` et inclut ce
+    qui est affecté pendant le run ; elle est partagée entre groupes, un
+    utilisateur pouvant couvrir plusieurs machines. Chaque groupe a son
+    tas ; une entrée périmée (charge modifiée via un autre groupe) est
+    remise à jour au moment où elle sort du tas.
 
-                c.execute("""
-                    INSERT INTO tasks (
-                        line, machine, description, assigned_to,
-                        status, points, frequency, documentation, created_at
-                    )
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                """, (
-                    line,
-                    machine,
-                    r.get("Description"),
-                    chosen,
-                    "en_cours",
-                    3,
-                    r.get("Frequence"),
-                    r.get("Documentation"),
-                    now
-                ))
-
-                task_count[chosen] += 1
-                created += 1
+    Retourne ([(groupe, template, user_id)], [groupes sans candidat]).
+    """
+    assignments = []
+    missing = []
 
-        db.commit()
-        db.close()
+    for key, templates in by_group.items():
+        user_ids = users_by_group.get(key, [])
+        if not user_ids:
+            missing.append(key)
+            continue
 
-        print("✅ AUTO ASSIGN PMP DONE:", created)
-        return created
+        heap = []
+        for u in set(user_ids):
+            load = workload.setdefault(u, [0, 0])
+            heap.append((load[0], load[1], u))
+        heapq.heapify(heap)
 
-    except Exception as e:
-        print("❌ ERROR IN _auto_assign_pmp:", repr(e))
-        raise
+        for r in templates:
+            while True:
+                pts, n, u = heapq.heappop(heap)
+                load = workload[u]
+                if (pts, n) == (load[0], load[1]):
+                    break
+                heapq.heappush(heap, (load[0], load[1], u))
 
+            assignments.append((key, r, u))
+            load[0] += points
+            load[1] += 1
+            heapq.heappush(heap, (load[0], load[1], u))
 
+    return assignments, missing
 
-# -------------------------------------------------------
-# ROUTES assignation automatique
-# -------------------------------------------------------
-@app.route("/admin/auto-assign/hebdo", methods=["POST"])
-def admin_auto_assign_hebdo():
-    try:
-        print(">>> AUTO ASSIGN HEBDO")
 
-        line = request.form.get("line")
-        if not line:
-            flash("Veuillez sélectionner une ligne", "warning")
-            return redirect(url_for("admin_assign_page"))
+GENERATED_TASK_COLUMNS = TASK_INSERT_COLUMNS + ("batch_id", "template_key")
 
-        created = _auto_assign_pmp(line, "hebdo")
 
-        flash(f"{created} tâches PMP hebdomadaires assignées", "success")
-        return redirect(url_for("admin_dashboard"))
+def generate_pmp_batch(lines, freq_prefixes, day=None, dry_run=False):
+    """Génère les tâches PMP de plusieurs lignes et fréquences en une transaction.
 
-    except Exception as e:
-        print("❌ ERROR AUTO ASSIGN HEBDO:", repr(e))
-        raise
+    Les modèles, les utilisateurs et leur charge sont lus une seule fois ;
+    la charge est partagée par tout le lot. Chaque (ligne, fréquence,
+    période) est réservé dans generation_batches : un lot déjà généré
+    n'est pas refait et son id est retourné. Avec `dry_run`, rien n'est
+    écrit et le rapport indique ce qui aurait été créé.
+    """
+    day = day or datetime.now().date()
+    lines = [l for l in dict.fromkeys(lines) if l]
+    freq_prefixes = [f.lower() for f in dict.fromkeys(freq_prefixes) if f]
+
+    result = {
+        "created": 0,
+        "by_line": {l: 0 for l in lines},
+        "by_frequency": {f: 0 for f in freq_prefixes},
+        "batches": [],
+        "task_ids": [],
+        "dry_run": dry_run,
+    }
+    if not lines or not freq_prefixes:
+        return result
 
+    print(">>> AUTO ASSIGN PMP STARTED:", lines, freq_prefixes, day)
 
-@app.route("/admin/auto-assign/mensuel", methods=["POST"])
-def admin_auto_assign_mensuel():
-    try:
-        print(">>> AUTO ASSIGN MENSUEL")
+    # ---------- modèles : une lecture, regroupés par (machine, rôle, ligne) ----------
+    by_group = defaultdict(list)
+    for r in query_task_templates(lines=lines, freq_codes=freq_prefixes):
+        matched = r["CodeFrequence"]
+        role = _role_from_intervenant(r.get("Intervenant"))
+        if not role:
+            continue
+        by_group[(r.get("Machine"), role, r.get("Ligne"))].append((matched, r))
 
-        line = request.form.get("line")
-        if not line:
-            flash("Veuillez sélectionner une ligne", "warning")
-            return redirect(url_for("admin_assign_page"))
+    if not by_group:
+        print("⚠️ Aucun template PMP trouvé")
+        return result
 
-        created = _auto_assign_pmp(line, "mensuel")
+    pairs = sorted({(key[2], matched) for key, items in by_group.items() for matched, _ in items})
+    periods = {f: period_key(f, day) for f in freq_prefixes}
 
-        flash(f"{created} tâches PMP mensuelles assignées", "success")
-        return redirect(url_for("admin_dashboard"))
+    db = get_db()
+    c = db.cursor()
 
-    except Exception as e:
-        print("❌ ERROR AUTO ASSIGN MENSUEL:", repr(e))
-        raise
-@app.route("/admin/auto-assign/quotidien", methods=["POST"])
-def admin_auto_assign_quotidien():
     try:
-        print(">>> AUTO ASSIGN QUOTIDIEN")
+        # ---------- réservation des lots (ligne, fréquence, période) ----------
+        batch_ids = {}
+        if not dry_run:
+            claimed = psycopg2.extras.execute_values(c, """
+                INSERT INTO generation_batches(line, frequency, period)
+                VALUES %s
+                ON CONFLICT (line, frequency, period) DO NOTHING
+                RETURNING id, line, frequency
+            """, [(l, f, periods[f]) for l, f in pairs], fetch=True)
+            batch_ids = {(b["line"], b["frequency"]): b["id"] for b in claimed}
+
+        existing = {}
+        c.execute("""
+            SELECT b.id, b.line, b.frequency, b.period, b.created_count
+            FROM generation_batches b
+            JOIN unnest(%s::text[], %s::text[], %s::text[]) AS p(line, frequency, period)
+              ON p.line = b.line AND p.frequency = b.frequency AND p.period = b.period
+        """, (
+            [l for l, _ in pairs],
+            [f for _, f in pairs],
+            [periods[f] for _, f in pairs],
+        ))
+        for b in c.fetchall():
+            if (b["line"], b["frequency"]) not in batch_ids:
+                existing[(b["line"], b["frequency"])] = b
+
+        # un lot existant n'est régénéré qu'en simulation (pour le rapport)
+        if not dry_run:
+            by_group = {
+                key: [(m, r) for m, r in items if (key[2], m) in batch_ids]
+                for key, items in by_group.items()
+            }
+            by_group = {key: items for key, items in by_group.items() if items}
 
-        line = request.form.get("line")
-        if not line:
-            flash("Veuillez sélectionner une ligne", "warning")
-            return redirect(url_for("admin_assign_page"))
+        c.execute("""
+            SELECT id, role, prod_line, machine_assigned
+            FROM users
+            WHERE prod_line = ANY(%s)
+        """, (lines,))
+        users = c.fetchall()
+
+        users_by_group = defaultdict(list)
+        for u in users:
+            machines = []
+            if u["machine_assigned"]:
+                machines = u["machine_assigned"].split("|")
 
-        created = _auto_assign_pmp(line, "quotidien")
+            for m in machines:
+                users_by_group[(m, u["role"], u["prod_line"])].append(u["id"])
 
-        flash(f"{created} tâches PMP quotidiennes assignées", "success")
-        return redirect(url_for("admin_dashboard"))
+        workload = _open_workload(c, [u["id"] for u in users])
+        assignments, missing = _balanced_assignments(
+            by_group, users_by_group, workload, points=3
+        )
+        for machine, role, line in missing:
+            print(f"⚠️ Aucun opérateur pour {machine} ({role}) sur {line}")
 
+        now = datetime.now().isoformat()
+        rows = []
+        planned = defaultdict(int)
+        for (machine, _, line), (matched, r), chosen in assignments:
+            planned[(line, matched)] += 1
+            rows.append((
+                line,
+                machine,
+                r.get("Description"),
+                chosen,
+                "en_cours",
+                3,
+                r.get("Frequence"),
+                r.get("Documentation"),
+                now,
+                batch_ids.get((line, matched)),
+                r.get("Cle"),
+            ))
+
+        if dry_run:
+            db.rollback()
+        else:
+            result["task_ids"] = _insert_tasks(
+                c, rows, GENERATED_TASK_COLUMNS,
+                on_conflict="ON CONFLICT (batch_id, template_key) WHERE batch_id IS NOT NULL DO NOTHING"
+            )
+            # compte final par lot ; un lot resté vide est libéré (rejouable)
+            c.execute("""
+                UPDATE generation_batches b
+                SET created_count = (SELECT COUNT(*) FROM tasks t WHERE t.batch_id = b.id)
+                WHERE b.id = ANY(%s)
+            """, (list(batch_ids.values()),))
+            c.execute("""
+                DELETE FROM generation_batches
+                WHERE id = ANY(%s) AND created_count = 0
+            """, (list(batch_ids.values()),))
+            db.commit()
     except Exception as e:
-        print("❌ ERROR AUTO ASSIGN QUOTIDIEN:", repr(e))
+        db.rollback()
+        print("❌ ERROR IN generate_pmp_batch:", repr(e))
         raise
+    finally:
+        db.close()
 
-@app.route("/admin/auto-assign/trimestriel", methods=["POST"])
-def admin_auto_assign_trimestriel():
-    try:
-        print(">>> AUTO ASSIGN TRIMESTRIEL")
+    for line, freq in pairs:
+        n = planned.get((line, freq), 0)
+        entry = {"line": line, "frequency": freq, "period": periods[freq]}
+        if (line, freq) in existing:
+            b = existing[(line, freq)]
+            entry.update(status="existing", batch_id=b["id"], created=b["created_count"])
+            if dry_run:
+                entry["would_create"] = n
+        elif dry_run:
+            entry.update(status="would_create", batch_id=None, created=0, would_create=n)
+        else:
+            entry.update(status="created" if n else "empty", batch_id=batch_ids.get((line, freq)) if n else None, created=n)
+            result["by_line"][line] += n
+            result["by_frequency"][freq] += n
+        result["batches"].append(entry)
+
+    result["created"] = len(result["task_ids"])
+    print("✅ AUTO ASSIGN PMP DONE:", result["created"])
+    return result
 
-        line = request.form.get("line")
-        if not line:
-            flash("Veuillez sélectionner une ligne", "warning")
-            return redirect(url_for("admin_assign_page"))
 
-        created = _auto_assign_pmp(line, "trimestriel")
+def _auto_assign_pmp(line: str, freq_prefix: str):
+    return generate_pmp_batch([line], [freq_prefix])["created"]
 
-        flash(f"{created} tâches PMP trimestrielles assignées", "success")
-        return redirect(url_for("admin_dashboard"))
 
-    except Exception as e:
-        print("❌ ERROR AUTO ASSIGN TRIMESTRIEL:", repr(e))
-        raise
+# -------------------------------------------------------
+# ROUTE assignation automatique (lignes × fréquences)
+# -------------------------------------------------------
+@app.route("/admin/auto-assign", methods=["POST"])
+@login_required(role="admin")
+def admin_auto_assign():
+    payload = request.get_json(silent=True) if request.is_json else None
+    if request.is_json:
+        # lines / frequencies : listes de textes ; date : texte AAAA-MM-JJ
+        body_ok = isinstance(payload, dict)
+        payload = payload if body_ok else {}
+        lines = payload.get("lines", [])
+        freqs = payload.get("frequencies", [])
+        dry_run = bool(payload.get("dry_run"))
+        day = payload.get("date")
+        if not (
+            body_ok
+            and isinstance(lines, list) and all(isinstance(l, str) for l in lines)
+            and isinstance(freqs, list) and all(isinstance(f, str) for f in freqs)
+            and (day is None or isinstance(day, str))
+        ):
+            return jsonify({
+                "error": "lines et frequencies doivent être des listes de textes, date un texte AAAA-MM-JJ"
+            }), 400
+    else:
+        lines = request.form.getlist("line")
+        freqs = request.form.getlist("frequency")
+        dry_run = request.form.get("dry_run") == "1"
+        day = request.form.get("date")
 
-@app.route("/admin/auto-assign/semestriel", methods=["POST"])
-def admin_auto_assign_semestriel():
-    try:
-        print(">>> AUTO ASSIGN SEMESTRIEL")
+    freqs = [f for f in freqs if f and f.lower() in PMP_FREQUENCIES]
 
-        line = request.form.get("line")
-        if not line:
-            flash("Veuillez sélectionner une ligne", "warning")
-            return redirect(url_for("admin_assign_page"))
+    if not lines or not freqs:
+        if payload is not None:
+            return jsonify({"error": "lines et frequencies sont requis"}), 400
+        flash("Veuillez sélectionner au moins une ligne et une fréquence", "warning")
+        return redirect(url_for("admin_auto_page"))
 
-        created = _auto_assign_pmp(line, "semestriel")
+    try:
+        day = datetime.strptime(day, "%Y-%m-%d").date() if day else None
+    except ValueError:
+        if payload is not None:
+            return jsonify({"error": "date invalide (AAAA-MM-JJ)"}), 400
+        flash("Date invalide", "warning")
+        return redirect(url_for("admin_auto_page"))
+
+    result = generate_pmp_batch(lines, freqs, day=day, dry_run=dry_run)
+
+    if payload is not None:
+        return jsonify({k: v for k, v in result.items() if k != "task_ids"})
+
+    existing = [b for b in result["batches"] if b["status"] == "existing"]
+    if dry_run:
+        would = sum(b.get("would_create", 0) for b in result["batches"])
+        flash(
+            f"Simulation : {would} tâches PMP seraient créées "
+            f"({len(existing)} lots déjà générés pour cette période)",
+            "success"
+        )
+        return redirect(url_for("admin_auto_page"))
 
-        flash(f"{created} tâches PMP semestrielles assignées", "success")
-        return redirect(url_for("admin_dashboard"))
+    detail = ", ".join(f"{f} : {n}" for f, n in result["by_frequency"].items())
+    message = f"{result['created']} tâches PMP assignées ({detail})"
+    if existing:
+        message += f" — {len(existing)} lots déjà générés pour cette période, ignorés"
+    flash(message, "success")
+    return redirect(url_for("admin_dashboard"))
 
-    except Exception as e:
-        print("❌ ERROR AUTO ASSIGN SEMESTRIEL:", repr(e))
-        raise
+# -------------------------------------------------------
+# PLANIFICATEUR : génération PMP récurrente (processus séparé)
+# -------------------------------------------------------
+# Lancé par `flask run-scheduler` (entrée "scheduler" du Procfile). Au
+# démarrage puis chaque jour à SCHEDULER_AT, tente toutes les fréquences pour
+# toutes les lignes du plan, une ligne par thread, sous un verrou consultatif
+# Postgres. Le registre generation_batches rend sans effet les périodes déjà
+# générées : un arrêt le lundi ou le 1er est rattrapé au passage suivant.
+# Un fil du même processus rafraîchit operator_daily_perf (PERF_REFRESH_INTERVAL).
+SCHEDULER_AT = os.environ.get("SCHEDULER_AT", "04:30")
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", "4"))
+SCHEDULER_LOCK_KEY = 7_340_002
+
+
+def run_scheduled_generation(day):
+    """Génère les PMP dues pour `day` ; None si un autre processus tient le verrou.
+
+    Toutes les fréquences sont tentées pour leur période en cours : seuls les
+    lots (ligne, fréquence, période) absents de generation_batches sont créés.
+    """
+    freqs = list(PMP_FREQUENCIES)
+    _, lines, _, _, _ = load_task_templates()
+
+    lock = get_db()
+    c = lock.cursor()
+    c.execute("SELECT pg_try_advisory_lock(%s) AS ok", (SCHEDULER_LOCK_KEY,))
+    if not c.fetchone()["ok"]:
+        lock.rollback()
+        lock.close()
+        print("⚠️ Génération planifiée déjà en cours ailleurs")
+        return None
+    lock.commit()
 
-@app.route("/admin/auto-assign/annuel", methods=["POST"])
-def admin_auto_assign_annuel():
+    summary = {"day": day.isoformat(), "frequencies": freqs, "created": 0, "by_line": {}}
     try:
-        print(">>> AUTO ASSIGN ANNUEL")
+        with ThreadPoolExecutor(max_workers=SCHEDULER_WORKERS) as pool:
+            futures = {pool.submit(generate_pmp_batch, [line], freqs, day): line for line in lines}
+            for future in as_completed(futures):
+                line = futures[future]
+                try:
+                    created = future.result()["created"]
+                except Exception as e:
+                    print(f"❌ ERREUR PLANIFICATEUR {line}:", repr(e))
+                    created = None
+                summary["by_line"][line] = created
+                summary["created"] += created or 0
+    finally:
+        c.execute("SELECT pg_advisory_unlock(%s)", (SCHEDULER_LOCK_KEY,))
+        lock.commit()
+        lock.close()
+
+    print("✅ GÉNÉRATION PLANIFIÉE:", summary)
+    return summary
+
+
+def _next_run(now):
+    hour, minute = (int(x) for x in SCHEDULER_AT.split(":"))
+    run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if run <= now:
+        run += timedelta(days=1)
+    return run
+
+
+@app.cli.command("run-scheduler")
+@click.option("--once", is_flag=True, help="Exécuter une seule génération puis quitter.")
+@click.option("--date", "day", default=None, help="Jour à générer (AAAA-MM-JJ, avec --once).")
+def run_scheduler_command(once, day):
+    """Planificateur de génération PMP (processus dédié)."""
+    if once:
+        target = datetime.strptime(day, "%Y-%m-%d").date() if day else datetime.now().date()
+        run_scheduled_generation(target)
+        return
 
-        line = request.form.get("line")
-        if not line:
-            flash("Veuillez sélectionner une ligne", "warning")
-            return redirect(url_for("admin_assign_page"))
+    threading.Thread(target=_perf_refresh_loop, name="perf-refresh", daemon=True).start()
 
-        created = _auto_assign_pmp(line, "annuel")
+    # premier passage immédiat : rattrape les périodes manquées pendant l'arrêt
+    run = datetime.now()
+    while True:
+        try:
+            run_scheduled_generation(run.date())
+        except Exception as e:
+            print("❌ ERREUR PLANIFICATEUR:", repr(e))
+        # rattrapage quotidien des compteurs user_stats
+        try:
+            drift = reconcile_user_stats(fix=True)
+            if drift:
+                print(f"⚠️ user_stats : {len(drift)} écart(s) corrigé(s)")
+        except Exception as e:
+            print("❌ ERREUR RÉCONCILIATION user_stats:", repr(e))
+        try:
+            purge_sync_operations()
+        except Exception as e:
+            print("❌ ERREUR PURGE sync_operations:", repr(e))
 
-        flash(f"{created} tâches PMP annuelles assignées", "success")
-        return redirect(url_for("admin_dashboard"))
+        run = _next_run(datetime.now())
+        click.echo(f"Prochaine génération PMP : {run:%Y-%m-%d %H:%M}")
+        time.sleep(max(0, (run - datetime.now()).total_seconds()))
 
-    except Exception as e:
-        print("❌ ERROR AUTO ASSIGN ANNUEL:", repr(e))
-        raise
 
 # -------------------------------------------------------
 # PAGE : Ajout manuel tâche
@@ -1186,10 +3042,10 @@ def admin_manual_create():
 
         db = get_db()
         c = db.cursor()
-        c.execute("""
-            INSERT INTO tasks(line, machine, description, assigned_to, status, points, frequency, created_at)
-            VALUES (%s,%s,%s,%s,'en_cours',%s,%s,%s)
-        """, (line, machine, description, assigned_to, points, frequence, datetime.now().isoformat()))
+        _insert_tasks(c, [(
+            line, machine, description, assigned_to, "en_cours",
+            points, frequence, None, datetime.now().isoformat(),
+        )])
         db.commit()
         db.close()
 
@@ -1203,54 +3059,213 @@ def admin_manual_create():
 
     return redirect("/admin/manual")
 # -------------------------------------------------------
-# PAGE : Tâches en cours (ADMIN)
+# RENDU EN FLUX (+ gzip) POUR LES GRANDES LISTES
 # -------------------------------------------------------
-@app.route("/admin/tasks/open")
-@login_required(role=(["admin","production_manager"]))
-def admin_tasks_open():
+# L'en-tête et les filtres partent tout de suite ; les lignes suivent au
+# fil du curseur. Les fragments Jinja sont regroupés par STREAM_CHUNK
+# octets, chaque bloc gzip est vidé (Z_SYNC_FLUSH) pour s'afficher aussitôt.
+STREAM_CHUNK = 8192
+
+
+def _stream_chunks(parts, gzip_out):
+    comp = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip_out else None
+    buf = []
+    size = 0
+    for part in parts:
+        buf.append(part)
+        size += len(part)
+        if size >= STREAM_CHUNK:
+            data = "".join(buf).encode("utf-8")
+            buf = []
+            size = 0
+            yield comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH) if comp else data
+    data = "".join(buf).encode("utf-8")
+    yield comp.compress(data) + comp.flush() if comp else data
+
+
+def stream_page(template_name, **context):
+    # les messages flash sont retirés de la session AVANT l'envoi des en-têtes
+    # (cookie de session) ; le gabarit relit ensuite la copie de la requête
+    get_flashed_messages()
+    gzip_out = "gzip" in request.accept_encodings
+    resp = Response(
+        _stream_chunks(stream_template(template_name, **context), gzip_out),
+        mimetype="text/html"
+    )
+    # le teardown de la requête passe AVANT le rendu du corps : la connexion
+    # (curseurs parcourus par le gabarit) est cédée à la réponse
+    conn = g.pop("db_conn", None)
+    g.pop("db_refs", None)
+    if conn is not None:
+        resp.call_on_close(lambda: _release_conn(conn))
+    resp.headers["Vary"] = "Accept-Encoding"
+    # pas de mise en tampon par un éventuel proxy nginx
+    resp.headers["X-Accel-Buffering"] = "no"
+    if gzip_out:
+        resp.headers["Content-Encoding"] = "gzip"
+    return resp
+
+
+# -------------------------------------------------------
+# PAGINATION PAR CLÉ (keyset) : (date, id) décroissants
+# -------------------------------------------------------
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 200
+
+
+def _page_size(raw):
+    try:
+        size = int(raw or PAGE_SIZE_DEFAULT)
+    except ValueError:
+        size = PAGE_SIZE_DEFAULT
+    return max(1, min(PAGE_SIZE_MAX, size))
+
+
+def encode_cursor(ts, row_id):
+    return f"{ts.isoformat()}~{row_id}"
+
+
+def decode_cursor(raw):
+    try:
+        ts, row_id = raw.rsplit("~", 1)
+        return datetime.fromisoformat(ts), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def approximate_count(c, from_sql, params):
+    # estimation du planificateur (aucune lecture de la table)
+    c.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 {from_sql}", params)
+    return int(c.fetchone()["QUERY PLAN"][0]["Plan"]["Plan Rows"])
+
+
+def keyset_page(c, select_sql, where, params, sort_col, id_col, size, after=None, before=None):
+    """Une page triée par (sort_col, id_col) décroissants.
+
+    `after` / `before` sont des curseurs décodés (date, id) : page suivante
+    (plus ancienne) ou précédente (plus récente). Retourne (lignes, curseur
+    suivant, curseur précédent).
+    """
+    where = list(where)
+    params = list(params)
+    if before:
+        where.append(f"({sort_col}, {id_col}) > (%s, %s)")
+        params.extend(before)
+        order = "ASC"
+    else:
+        if after:
+            where.append(f"({sort_col}, {id_col}) < (%s, %s)")
+            params.extend(after)
+        order = "DESC"
+
+    where_sql = "WHERE " + " AND ".join(where) if where else ""
+    c.execute(f"""
+        {select_sql}
+        {where_sql}
+        ORDER BY {sort_col} {order}, {id_col} {order}
+        LIMIT %s
+    """, params + [size + 1])
+    rows = c.fetchall()
+
+    more = len(rows) > size
+    rows = rows[:size]
+    if before:
+        rows.reverse()
+    if not rows:
+        return rows, None, None
+
+    sort_key = sort_col.split(".")[-1]
+    id_key = id_col.split(".")[-1]
+    has_next = True if before else more
+    has_prev = more if before else bool(after)
+
+    next_cursor = encode_cursor(rows[-1][sort_key], rows[-1][id_key]) if has_next else None
+    prev_cursor = encode_cursor(rows[0][sort_key], rows[0][id_key]) if has_prev else None
+    return rows, next_cursor, prev_cursor
+
+
+def keyset_stream(db, c, page, *args, **kwargs):
+    """keyset_page paresseux pour stream_page : exécuté au premier parcours.
+
+    Les curseurs suivant / précédent sont posés dans `page` avant la
+    première ligne (la pagination est rendue après le tableau).
+    """
+    try:
+        rows, page["next"], page["prev"] = keyset_page(c, *args, **kwargs)
+        yield from rows
+    finally:
+        db.close()
+
+
+def _admin_task_list(status, date_col):
     line       = (request.args.get("line") or "").strip()
     machine    = (request.args.get("machine") or "").strip()
     start_date = (request.args.get("start_date") or "").strip()
     end_date   = (request.args.get("end_date") or "").strip()
+    size = _page_size(request.args.get("size"))
+    want_count = request.args.get("count") == "1"
 
-    where = ["t.status='en_cours'"]
-    params = []
+    where = ["t.status=%s"]
+    params = [status]
 
     if line:
         where.append("t.line=%s")
         params.append(line)
     if machine:
-        where.append("t.machine=%s")
-        params.append(machine)
-    if start_date:
-        where.append("DATE(t.created_at)>= %s")
-        params.append(start_date)
-    if end_date:
-        where.append("DATE(t.created_at)<= %s")
-        params.append(end_date)
-
-    where_sql = "WHERE " + " AND ".join(where)
+        where.append("t.machine=%s")
+        params.append(machine)
+    _append_date_range(where, params, f"t.{date_col}", start_date, end_date)
+
+    filters = {"line": line, "machine": machine, "start_date": start_date, "end_date": end_date}
+    page = {
+        "size": size,
+        "next": None,
+        "prev": None,
+        "approx_total": None,
+        # paramètres d'URL conservés d'une page à l'autre
+        "args": {k: v for k, v in filters.items() if v} | {"size": size},
+    }
 
     db = get_db()
     c = db.cursor()
-    c.execute(f"""
+    if want_count:
+        page["approx_total"] = approximate_count(
+            c, "FROM tasks t WHERE " + " AND ".join(where), params
+        )
+
+    # la requête part quand le template atteint le tableau (rendu en flux)
+    tasks = keyset_stream(
+        db, c, page,
+        """
         SELECT t.*, u.username
         FROM tasks t
         JOIN users u ON u.id = t.assigned_to
-        {where_sql}
-        ORDER BY t.created_at DESC
-    """, params)
-    tasks = c.fetchall()
-    db.close()
+        """,
+        where, params,
+        f"t.{date_col}", "t.id", size,
+        after=decode_cursor(request.args.get("after")),
+        before=decode_cursor(request.args.get("before")),
+    )
+    return tasks, filters, page
+
+
+# -------------------------------------------------------
+# PAGE : Tâches en cours (ADMIN)
+# -------------------------------------------------------
+@app.route("/admin/tasks/open")
+@login_required(role=(["admin","production_manager"]))
+def admin_tasks_open():
+    tasks, filters, page = _admin_task_list("en_cours", "created_at")
 
     _, lignes, machines_par_ligne, _, _ = load_task_templates()
 
-    return render_template(
+    return stream_page(
         "admin_tasks_open.html",
         tasks=tasks,
         lignes=lignes,
         machines_par_ligne=machines_par_ligne,
-        filters={"line":line,"machine":machine,"start_date":start_date,"end_date":end_date},
+        filters=filters,
+        page=page,
         current_year=datetime.now().year
     )
 
@@ -1260,52 +3275,175 @@ def admin_tasks_open():
 @app.route("/admin/tasks/closed")
 @login_required(role=(["admin","production_manager"]))
 def admin_tasks_closed():
-    line       = (request.args.get("line") or "").strip()
-    machine    = (request.args.get("machine") or "").strip()
-    start_date = (request.args.get("start_date") or "").strip()
-    end_date   = (request.args.get("end_date") or "").strip()
-
-    where = ["t.status='cloturee'"]
-    params = []
-
-    if line:
-        where.append("t.line=%s")
-        params.append(line)
-    if machine:
-        where.append("t.machine=%s")
-        params.append(machine)
-    if start_date:
-        where.append("DATE(t.closed_at)>= %s")
-        params.append(start_date)
-    if end_date:
-        where.append("DATE(t.closed_at)<= %s")
-        params.append(end_date)
-
-    where_sql = "WHERE " + " AND ".join(where)
-
-    db = get_db()
-    c = db.cursor()
-    c.execute(f"""
-        SELECT t.*, u.username
-        FROM tasks t
-        JOIN users u ON u.id = t.assigned_to
-        {where_sql}
-        ORDER BY t.closed_at DESC
-    """, params)
-    tasks = c.fetchall()
-    db.close()
+    tasks, filters, page = _admin_task_list("cloturee", "closed_at")
 
     _, lignes, machines_par_ligne, _, _ = load_task_templates()
 
-    return render_template(
+    return stream_page(
         "admin_tasks_closed.html",
         tasks=tasks,
         lignes=lignes,
         machines_par_ligne=machines_par_ligne,
-        filters={"line":line,"machine":machine,"start_date":start_date,"end_date":end_date},
+        filters=filters,
+        page=page,
         current_year=datetime.now().year
     )
 
+# -------------------------------------------------------
+# EXPORT CSV / XLSX (curseur serveur, réponse en flux)
+# -------------------------------------------------------
+# type -> (en-têtes, SELECT ... FROM ..., conditions fixes, colonne date,
+# colonne ligne, colonne machine). Mêmes filtres que les pages de liste.
+EXPORTS = {
+    "open": (
+        ["ID", "Ligne", "Machine", "Description", "Fréquence", "Assignée à", "Points", "Créée le"],
+        """
+        SELECT t.id, t.line, t.machine, t.description, t.frequency, u.username, t.points, t.created_at
+        FROM tasks t
+        JOIN users u ON u.id = t.assigned_to
+        """,
+        ["t.status='en_cours'"], "t.created_at", "t.line", "t.machine",
+    ),
+    "closed": (
+        ["ID", "Ligne", "Machine", "Description", "Fréquence", "Assignée à", "Points",
+         "Clôturée le", "Confirmée chef"],
+        """
+        SELECT t.id, t.line, t.machine, t.description, t.frequency, u.username, t.points,
+               t.closed_at, t.validated_by_leader
+        FROM tasks t
+        JOIN users u ON u.id = t.assigned_to
+        """,
+        ["t.status='cloturee'"], "t.closed_at", "t.line", "t.machine",
+    ),
+    "feedback": (
+        ["ID", "Tâche", "Opérateur", "Ligne", "Machine", "Commentaire", "Date", "Traité"],
+        """
+        SELECT f.id, f.task_id, u.username, t.line, t.machine, f.comment, f.created_at, f.treated
+        FROM feedback_form f
+        JOIN users u ON u.id = f.user_id
+        JOIN tasks t ON t.id = f.task_id
+        """,
+        [], "f.created_at", "t.line", "t.machine",
+    ),
+    "anomalies": (
+        ["ID", "Opérateur", "Ligne", "Machine", "Description", "Criticité", "Date", "Traitée"],
+        """
+        SELECT m.id, u.username, m.line, m.machine, m.description, m.severity, m.created_at, m.treated
+        FROM machine_anomalies m
+        LEFT JOIN users u ON u.id = m.user_id
+        """,
+        [], "m.created_at", "m.line", "m.machine",
+    ),
+}
+
+EXPORT_FETCH_SIZE = 2000
+
+
+def _export_rows(kind, filters):
+    """Itère sur les lignes de l'export via un curseur nommé (côté serveur)."""
+    _, select_sql, base_where, date_col, line_col, machine_col = EXPORTS[kind]
+
+    where = list(base_where)
+    params = []
+    if filters["line"]:
+        where.append(f"{line_col}=%s")
+        params.append(filters["line"])
+    if filters["machine"]:
+        where.append(f"{machine_col}=%s")
+        params.append(filters["machine"])
+    _append_date_range(where, params, date_col, filters["start_date"], filters["end_date"])
+    where_sql = "WHERE " + " AND ".join(where) if where else ""
+
+    db = get_db()
+    c = db.cursor(name=f"export_{kind}", cursor_factory=psycopg2.extensions.cursor)
+    c.itersize = EXPORT_FETCH_SIZE
+    try:
+        c.execute(f"{select_sql} {where_sql} ORDER BY {date_col} DESC", params)
+        for row in c:
+            yield row
+    finally:
+        c.close()
+        db.close()
+
+
+def _csv_stream(headers, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=";")
+
+    def flush():
+        data = buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+        return data.encode("utf-8")
+
+    # BOM : Excel (FR) ouvre directement le fichier en UTF-8
+    yield "\ufeff".encode("utf-8")
+    writer.writerow(headers)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % 500 == 0:
+            yield flush()
+    yield flush()
+
+
+def _xlsx_stream(headers, rows):
+    # mode write-only : les lignes partent dans des fichiers temporaires,
+    # le classeur final est ensuite envoyé par blocs
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Export")
+    ws.append(headers)
+    for row in rows:
+        ws.append(list(row))
+
+    with tempfile.TemporaryFile() as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            chunk = tmp.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+
+@app.route("/admin/export/<kind>.<fmt>")
+@login_required(role=(["admin","production_manager"]))
+def admin_export(kind, fmt):
+    if kind not in EXPORTS or fmt not in ("csv", "xlsx"):
+        abort(404)
+
+    filters = {
+        "line": (request.args.get("line") or "").strip(),
+        "machine": (request.args.get("machine") or "").strip(),
+        "start_date": (request.args.get("start_date") or "").strip(),
+        "end_date": (request.args.get("end_date") or "").strip(),
+    }
+    headers = EXPORTS[kind][0]
+    rows = _export_rows(kind, filters)
+    filename = f"pmp_{kind}_{datetime.now():%Y%m%d_%H%M}.{fmt}"
+
+    if fmt == "csv":
+        body = _csv_stream(headers, rows)
+        mimetype = "text/csv; charset=utf-8"
+    else:
+        body = _xlsx_stream(headers, rows)
+        mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def _iter_cursor(db, c):
+    """Parcourt un curseur nommé pendant le rendu, puis libère la connexion."""
+    try:
+        yield from c
+    finally:
+        c.close()
+        db.close()
+
+
 # -------------------------------------------------------
 # OPÉRATEUR : tableau de bord
 # -------------------------------------------------------
@@ -1319,6 +3457,8 @@ def operator_dashboard():
 
     # récupération filtre bouton
     freq = (request.args.get("freq") or "").lower()
+    if freq not in PMP_FREQUENCIES:
+        freq = ""
 
     # 🔥 requête principale (SAFE psycopg2)
     query = """
@@ -1326,11 +3466,9 @@ def operator_dashboard():
     FROM tasks
     WHERE assigned_to = %s
     AND (
-        (LOWER(COALESCE(frequency,'')) LIKE 'quotidien%%' AND created_at >= NOW() - INTERVAL '1 day')
-        OR
-        (LOWER(COALESCE(frequency,'')) NOT LIKE 'quotidien%%' AND created_at >= NOW() - INTERVAL '7 days')
-        OR
-        frequency IS NULL
+        due_at > NOW() OR frequency IS NULL
+        -- tâches ouvertes en retard : restent affichées (en rouge) une semaine
+        OR (status = 'en_cours' AND due_at > NOW() - INTERVAL '7 days')
     )
     """
 
@@ -1338,44 +3476,42 @@ def operator_dashboard():
 
     # 🔥 filtre par fréquence (boutons)
     if freq:
-        query += " AND LOWER(COALESCE(frequency,'')) LIKE %s"
-        params.append(freq + "%")
+        query += " AND frequency_code = %s"
+        params.append(freq)
 
     query += """
     ORDER BY
     CASE status WHEN 'en_cours' THEN 0 ELSE 1 END,
-    created_at DESC
+    due_at
     """
 
     # DEBUG (tu peux supprimer après test)
     print("QUERY:", query)
     print("PARAMS:", params)
 
-    c.execute(query, params)
-    tasks = c.fetchall()
-
-    # 🔥 KPI
+    # 🔥 KPI (d'abord : affiché dans l'en-tête) : compteurs tenus à jour
     c.execute("""
-        SELECT 
-            COUNT(*) FILTER (WHERE status='en_cours') AS en_cours,
-            COUNT(*) FILTER (WHERE status='cloturee') AS cloturees,
-            COALESCE(SUM(points) FILTER (WHERE status='cloturee'),0) AS score
-        FROM tasks
-        WHERE assigned_to=%s
+        SELECT open_count AS en_cours, closed_count AS cloturees, score
+        FROM user_stats
+        WHERE user_id=%s
     """, (user["id"],))
 
-    kpi = c.fetchone()
+    kpi = c.fetchone() or {"en_cours": 0, "cloturees": 0, "score": 0}
 
-    db.close()
+    # tâches : curseur nommé parcouru pendant le rendu en flux
+    tasks_cur = db.cursor(name="operator_tasks")
+    tasks_cur.itersize = 200
+    tasks_cur.execute(query, params)
 
-    return render_template(
+    return stream_page(
         "operator_dashboard.html",
         me=user,
-        tasks=tasks,
+        tasks=_iter_cursor(db, tasks_cur),
         taches_en_cours=kpi["en_cours"],
         taches_cloturees=kpi["cloturees"],
         score_total=kpi["score"],
-        current_freq=freq
+        current_freq=freq,
+        now=datetime.now()
     )
 # -------------------------------------------------------
 # REDIRECTION PLATEFORME SELON UTILISATEUR
@@ -1400,6 +3536,306 @@ def platform_redirect():
     else:
         return redirect(url_for("operator_dashboard"))
  
+def close_user_tasks(c, user_id, items):
+    """Clôture en une instruction les tâches ouvertes de `user_id`.
+
+    `items` : {task_id: commentaire}. Une CTE vérifie l'appartenance,
+    clôture les tâches encore ouvertes et insère un feedback pour chaque
+    commentaire non vide ; user_stats suit dans la même transaction.
+    Retourne les lignes clôturées (id, points, closed_at, with_feedback).
+    Pas de commit : l'appelant garde la main sur la transaction.
+    """
+    if not items:
+        return []
+    ids = sorted(items)
+    c.execute("""
+        WITH input(task_id, comment) AS (
+            SELECT * FROM unnest(%(ids)s::int[], %(comments)s::text[])
+        ),
+        closed AS (
+            UPDATE tasks t
+            SET status='cloturee', closed_at=NOW()
+            FROM input i
+            WHERE t.id = i.task_id
+            AND t.assigned_to = %(user_id)s
+            AND t.status = 'en_cours'
+            RETURNING t.id, t.assigned_to, t.points, t.closed_at
+        ),
+        feedback AS (
+            INSERT INTO feedback_form (task_id, user_id, comment)
+            SELECT cl.id, %(user_id)s, TRIM(i.comment)
+            FROM closed cl
+            JOIN input i ON i.task_id = cl.id
+            WHERE COALESCE(TRIM(i.comment), '') <> ''
+            RETURNING task_id
+        )
+        SELECT cl.*, (cl.id IN (SELECT task_id FROM feedback)) AS with_feedback
+        FROM closed cl
+        ORDER BY cl.id
+    """, {
+        "ids": ids,
+        "comments": [items[i] for i in ids],
+        "user_id": user_id,
+    })
+    closed = c.fetchall()
+    _close_user_stats(c, closed)
+    return closed
+
+
+@app.route("/me/tasks/close", methods=["POST"])
+@login_required()
+def me_tasks_close():
+    # formulaire : cases task_ids (+ comment_<id> facultatif)
+    # JSON : {"tasks": [{"id": 1, "comment": "..."}]} ou {"task_ids": [...]}
+    user = current_user()
+    try:
+        if request.is_json:
+            data = request.get_json(silent=True)
+            items = {t: None for t in _json_task_ids(data)}
+            tasks = data.get("tasks", [])
+            if not isinstance(tasks, list):
+                raise TypeError(tasks)
+            for t in tasks:
+                if not isinstance(t, dict) or not isinstance(t.get("comment"), (str, type(None))):
+                    raise TypeError(t)
+                if isinstance(t["id"], (bool, float)):
+                    raise TypeError(t)
+                items[int(t["id"])] = t.get("comment")
+        else:
+            items = {
+                int(t): request.form.get(f"comment_{t}")
+                for t in request.form.getlist("task_ids")
+            }
+    except (TypeError, ValueError, KeyError):
+        if request.is_json:
+            return jsonify({"error": "task_ids et tasks doivent être des listes (commentaire : texte ou null)"}), 400
+        flash("Sélection invalide.", "err")
+        return redirect(url_for("operator_dashboard"))
+
+    db = get_db()
+    c = db.cursor()
+    closed = close_user_tasks(c, user["id"], items)
+    db.commit()
+    db.close()
+
+    closed_ids = [t["id"] for t in closed]
+    if request.is_json:
+        return jsonify({
+            "closed": closed_ids,
+            "ignored": [t for t in sorted(items) if t not in set(closed_ids)],
+        })
+
+    if closed_ids:
+        flash(f"{len(closed_ids)} tâche(s) clôturée(s).", "ok")
+    else:
+        flash("Aucune tâche clôturée.", "err")
+    return redirect(url_for("operator_dashboard"))
+
+
+# -------------------------------------------------------
+# SYNCHRONISATION HORS LIGNE (tablettes)
+# -------------------------------------------------------
+# La tablette met en file ses clôtures, commentaires et anomalies, chacun
+# avec une clé générée côté client, puis envoie la file en un POST :
+#   {"items": [{"key": "...", "type": "close", "task_id": 12, "comment": "..."},
+#              {"key": "...", "type": "feedback", "task_id": 12, "comment": "..."},
+#              {"key": "...", "type": "anomaly", "line": "...", "machine": "...",
+#               "description": "...", "severity": "HIGH"}]}
+# Tout est appliqué dans une transaction ; une clé déjà vue renvoie le
+# résultat enregistré (son statut d'origine, avec "duplicate": true) sans
+# rien réappliquer.
+SYNC_MAX_ITEMS = 500
+SYNC_KEY_TTL_DAYS = 30
+SYNC_TYPES = ("close", "feedback", "anomaly")
+TASK_ID_MAX = 2**31 - 1  # tasks.id est un integer Postgres
+
+
+def _sync_item_error(item):
+    kind = item.get("type")
+    if kind not in SYNC_TYPES:
+        return f"type doit valoir {', '.join(SYNC_TYPES)}"
+    if kind in ("close", "feedback"):
+        # bool est un int en Python : true fermerait la tâche n° 1
+        task_id = item.get("task_id")
+        if not isinstance(task_id, int) or isinstance(task_id, bool):
+            return "task_id entier requis"
+        if not 0 < task_id <= TASK_ID_MAX:
+            return "task_id hors limites"
+        if kind == "feedback" and not str(item.get("comment") or "").strip():
+            return "comment requis"
+    if kind == "anomaly":
+        missing = [f for f in ("line", "machine", "description") if not str(item.get(f) or "").strip()]
+        if missing:
+            return f"champs requis : {', '.join(missing)}"
+    return None
+
+
+def apply_sync_batch(user_id, items):
+    """Applique une file hors ligne ; retourne un résultat par élément, dans l'ordre."""
+    results = [None] * len(items)
+    todo = {}
+    repeated = []
+    for n, item in enumerate(items):
+        key = str(item.get("key") or "").strip() if isinstance(item, dict) else ""
+        if not key:
+            results[n] = {"key": None, "status": "rejected", "error": "key requise"}
+            continue
+        error = _sync_item_error(item)
+        if error:
+            results[n] = {"key": key, "status": "rejected", "error": error}
+        elif key in todo:
+            repeated.append((n, key))
+        else:
+            todo[key] = (n, item)
+
+    if not todo:
+        return results
+
+    db = get_db()
+    c = db.cursor()
+    try:
+        # ---------- réservation des clés (les clés déjà vues sont rejouées) ----------
+        keys = list(todo)
+        claimed = psycopg2.extras.execute_values(c, """
+            INSERT INTO sync_operations(user_id, key, kind)
+            VALUES %s
+            ON CONFLICT (user_id, key) DO NOTHING
+            RETURNING key
+        """, [(user_id, k, todo[k][1]["type"]) for k in keys], fetch=True)
+        claimed = {r["key"] for r in claimed}
+
+        seen = [k for k in keys if k not in claimed]
+        if seen:
+            c.execute("""
+                SELECT key, result FROM sync_operations
+                WHERE user_id = %s AND key = ANY(%s)
+            """, (user_id, seen))
+            for r in c.fetchall():
+                n = todo[r["key"]][0]
+                results[n] = dict(r["result"] or {}, key=r["key"], duplicate=True)
+
+        applied = {}
+        new = [(k, todo[k][1]) for k in keys if k in claimed]
+
+        # ---------- clôtures : une instruction (voir close_user_tasks) ----------
+        closes = {}
+        for k, item in new:
+            if item["type"] == "close":
+                closes.setdefault(item["task_id"], []).append(k)
+        if closes:
+            comments = {}
+            for k, item in new:
+                if item["type"] == "close" and item.get("comment"):
+                    comments[item["task_id"]] = str(item["comment"])
+            closed = {
+                t["id"]: t
+                for t in close_user_tasks(c, user_id, {tid: comments.get(tid) for tid in closes})
+            }
+            for tid, ks in closes.items():
+                for k in ks:
+                    if tid in closed:
+                        applied[k] = {
+                            "status": "applied",
+                            "task_id": tid,
+                            "closed_at": closed[tid]["closed_at"].isoformat(),
+                        }
+                        closed.pop(tid)
+                    else:
+                        applied[k] = {"status": "not_applied", "task_id": tid,
+                                      "error": "tâche introuvable ou déjà clôturée"}
+
+        # ---------- commentaires sur des tâches de l'opérateur ----------
+        feedback = [(k, item) for k, item in new if item["type"] == "feedback"]
+        if feedback:
+            c.execute(
+                "SELECT id FROM tasks WHERE assigned_to = %s AND id = ANY(%s)",
+                (user_id, [item["task_id"] for _, item in feedback])
+            )
+            owned = {r["id"] for r in c.fetchall()}
+            rows = [(k, item) for k, item in feedback if item["task_id"] in owned]
+            inserted = psycopg2.extras.execute_values(c, """
+                INSERT INTO feedback_form (task_id, user_id, comment)
+                VALUES %s
+                RETURNING id
+            """, [(item["task_id"], user_id, str(item["comment"]).strip()) for _, item in rows],
+                fetch=True) if rows else []
+            for (k, item), r in zip(rows, inserted):
+                applied[k] = {"status": "applied", "task_id": item["task_id"], "feedback_id": r["id"]}
+            for k, item in feedback:
+                if item["task_id"] not in owned:
+                    applied[k] = {"status": "not_applied", "task_id": item["task_id"],
+                                  "error": "tâche introuvable"}
+
+        # ---------- anomalies machine ----------
+        anomalies = [(k, item) for k, item in new if item["type"] == "anomaly"]
+        if anomalies:
+            inserted = psycopg2.extras.execute_values(c, """
+                INSERT INTO machine_anomalies(user_id, line, machine, description, severity)
+                VALUES %s
+                RETURNING id
+            """, [
+                (user_id, item["line"], item["machine"], item["description"], item.get("severity"))
+                for _, item in anomalies
+            ], fetch=True)
+            for (k, _), r in zip(anomalies, inserted):
+                applied[k] = {"status": "applied", "anomaly_id": r["id"]}
+
+        # ---------- résultats mémorisés pour les rejeux ----------
+        if applied:
+            psycopg2.extras.execute_values(c, """
+                UPDATE sync_operations s
+                SET result = v.result::jsonb
+                FROM (VALUES %s) AS v(user_id, key, result)
+                WHERE s.user_id = v.user_id AND s.key = v.key
+            """, [
+                (user_id, k, psycopg2.extras.Json(r)) for k, r in applied.items()
+            ])
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    for k, r in applied.items():
+        results[todo[k][0]] = dict(r, key=k)
+    # clé répétée dans le même lot : résultat de la première occurrence
+    for n, key in repeated:
+        results[n] = dict(results[todo[key][0]], duplicate=True)
+    return results
+
+
+def purge_sync_operations():
+    db = get_db()
+    c = db.cursor()
+    c.execute(
+        "DELETE FROM sync_operations WHERE created_at < NOW() - %s * INTERVAL '1 day'",
+        (SYNC_KEY_TTL_DAYS,)
+    )
+    n = c.rowcount
+    db.commit()
+    db.close()
+    return n
+
+
+@app.route("/api/sync", methods=["POST"])
+@login_required()
+def api_sync():
+    data = request.get_json(silent=True)
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return jsonify({"error": "corps attendu : {\"items\": [...]}"}), 400
+    if len(items) > SYNC_MAX_ITEMS:
+        return jsonify({"error": f"au plus {SYNC_MAX_ITEMS} éléments par envoi"}), 413
+
+    results = apply_sync_batch(current_user()["id"], items)
+    return jsonify({
+        "results": results,
+        "applied": sum(1 for r in results if r["status"] == "applied" and not r.get("duplicate")),
+    })
+
+
 @app.route("/me/task/feedback/<int:task_id>", methods=["GET", "POST"])
 @login_required()
 def me_task_feedback(task_id):
@@ -1423,19 +3859,8 @@ def me_task_feedback(task_id):
     if request.method == "POST":
         comment = request.form.get("comment", "").strip()
 
-        # 👉 Insérer feedback UNIQUEMENT si commentaire non vide
-        if comment:
-            cur.execute("""
-                INSERT INTO feedback_form (task_id, user_id, comment)
-                VALUES (%s, %s, %s)
-            """, (task_id, user["id"], comment))
-
-        # 👉 Clôturer la tâche (TOUJOURS)
-        cur.execute("""
-            UPDATE tasks
-            SET status='cloturee', closed_at=NOW()
-            WHERE id=%s
-        """, (task_id,))
+        # 👉 Clôturer la tâche (feedback UNIQUEMENT si commentaire non vide)
+        close_user_tasks(cur, user["id"], {task_id: comment})
 
         conn.commit()
         cur.close()
@@ -1516,19 +3941,16 @@ def leader_validate_task(task_id):
 
     db = get_db()
     c = db.cursor()
-
-    c.execute("""
-        UPDATE tasks
-        SET validated_by_leader = TRUE
-        WHERE id=%s
-    """,(task_id,))
-
+    validated = _validate_team_tasks(c, user["id"], [task_id])
     db.commit()
     db.close()
 
-    flash("Tâche confirmée","ok")
+    if validated:
+        flash("Tâche confirmée","ok")
+    else:
+        flash("Action interdite.", "err")
 
-    return redirect(url_for("team_leader_dashboard"))
+    return redirect(url_for("leader_tasks_validate"))
 @app.route("/production")
 @login_required()
 def production_dashboard():
@@ -1538,26 +3960,478 @@ def production_dashboard():
     if user["role"] != "production_manager":
         return redirect(url_for("index"))
 
+    # KPI en une requête ; la liste des tâches est chargée par /api/production/tasks
     kpi = get_global_kpis()
+    _, lignes, machines_par_ligne, _, _ = load_task_templates()
+
+    return render_template(
+        "production_dashboard.html",
+        lignes=lignes,
+        machines_par_ligne=machines_par_ligne,
+        current_year=datetime.now().year,
+        **kpi
+    )
+
+
+# -------------------------------------------------------
+# API JSON : tâches de production (filtres, pages, colonnes)
+# -------------------------------------------------------
+TASK_API_FIELDS = (
+    "id", "line", "machine", "description", "status", "points", "frequency",
+    "frequency_code", "documentation", "assigned_to", "validated_by_leader",
+    "created_at", "due_at", "closed_at", "updated_at",
+)
+
+
+def _task_json(row):
+    return {
+        k: (v.isoformat() if isinstance(v, datetime) else v)
+        for k, v in row.items()
+    }
+
+
+@app.route("/api/production/tasks")
+@login_required(role=["production_manager", "admin"])
+def api_production_tasks():
+    filters = {
+        "line": (request.args.get("line") or "").strip(),
+        "machine": (request.args.get("machine") or "").strip(),
+        "start_date": (request.args.get("start_date") or "").strip(),
+        "end_date": (request.args.get("end_date") or "").strip(),
+    }
+    status = (request.args.get("status") or "").strip()
+    size = _page_size(request.args.get("size"))
+
+    # projection : seulement les colonnes demandées (id et created_at servent au curseur)
+    requested = [f.strip() for f in (request.args.get("fields") or "").split(",") if f.strip()]
+    unknown = [f for f in requested if f not in TASK_API_FIELDS]
+    if unknown:
+        return jsonify({"error": f"champs inconnus : {', '.join(unknown)}"}), 400
+    fields = list(dict.fromkeys(["id", "created_at"] + (requested or list(TASK_API_FIELDS))))
+
+    if status and status not in ("en_cours", "cloturee"):
+        return jsonify({"error": "status doit valoir en_cours ou cloturee"}), 400
+
+    where = []
+    params = []
+    if filters["line"]:
+        where.append("t.line=%s")
+        params.append(filters["line"])
+    if filters["machine"]:
+        where.append("t.machine=%s")
+        params.append(filters["machine"])
+    if status:
+        where.append("t.status=%s")
+        params.append(status)
+    _append_date_range(where, params, "t.created_at", filters["start_date"], filters["end_date"])
+
+    db = get_db()
+    c = db.cursor()
+    tasks, next_cursor, prev_cursor = keyset_page(
+        c,
+        f"SELECT {', '.join('t.' + f for f in fields)} FROM tasks t",
+        where, params,
+        "t.created_at", "t.id", size,
+        after=decode_cursor(request.args.get("after")),
+        before=decode_cursor(request.args.get("before")),
+    )
+    db.close()
+
+    payload = {
+        "tasks": [_task_json(t) for t in tasks],
+        "fields": fields,
+        "size": size,
+        "next": next_cursor,
+        "prev": prev_cursor,
+    }
+    if request.args.get("kpi") == "1":
+        payload["kpi"] = get_global_kpis(filters)
+    return jsonify(payload)
+
+
+# -------------------------------------------------------
+# API : tâches en retard / à risque
+# -------------------------------------------------------
+# Seules les tâches ouvertes dues avant NOW() + horizon sont lues (index
+# partiels sur due_at) : le coût ne dépend pas de l'historique clôturé.
+OVERDUE_GROUPS = {
+    "line": "t.line",
+    "machine": "t.line, t.machine",
+    "operator": "t.assigned_to",
+}
+AT_RISK_HOURS_DEFAULT = 24
+
+
+@app.route("/api/tasks/overdue")
+@login_required(role=["production_manager", "admin", "team_leader"])
+def api_tasks_overdue():
+    by = request.args.get("by") or "line"
+    if by not in OVERDUE_GROUPS:
+        return jsonify({"error": f"by doit valoir {', '.join(OVERDUE_GROUPS)}"}), 400
+    try:
+        horizon = int(request.args.get("horizon") or AT_RISK_HOURS_DEFAULT)
+    except ValueError:
+        return jsonify({"error": "horizon doit être un nombre d'heures"}), 400
+    horizon = max(0, min(horizon, 24 * 31))
+
+    where = ["t.status = 'en_cours'", "t.due_at < NOW() + %s * INTERVAL '1 hour'"]
+    params = [horizon]
+    for key in ("line", "machine"):
+        value = (request.args.get(key) or "").strip()
+        if value:
+            where.append(f"t.{key} = %s")
+            params.append(value)
+
+    # un chef d'équipe ne voit que son équipe
+    if session_role() == "team_leader":
+        where.append("t.assigned_to IN (SELECT id FROM users WHERE team_leader_id = %s)")
+        params.append(current_user()["id"])
+
+    group_cols = OVERDUE_GROUPS[by]
+    sql = f"""
+        SELECT {group_cols},
+               COUNT(*) FILTER (WHERE t.due_at < NOW()) AS overdue,
+               COUNT(*) FILTER (WHERE t.due_at >= NOW()) AS at_risk,
+               MIN(t.due_at) AS oldest_due
+        FROM tasks t
+        WHERE {" AND ".join(where)}
+        GROUP BY {group_cols}
+    """
+    if by == "operator":
+        # agrégat sur l'index, puis jointure sur les seuls opérateurs concernés
+        sql = f"""
+            SELECT a.*, u.username, u.prod_line
+            FROM ({sql}) a
+            JOIN users u ON u.id = a.assigned_to
+        """
 
     db = get_db()
     c = db.cursor()
+    c.execute(sql + " ORDER BY overdue DESC, oldest_due", params)
+    groups = [_task_json(r) for r in c.fetchall()]
+    db.close()
+
+    return jsonify({
+        "by": by,
+        "horizon_hours": horizon,
+        "overdue": sum(g["overdue"] for g in groups),
+        "at_risk": sum(g["at_risk"] for g in groups),
+        "groups": groups,
+    })
+
+
+# -------------------------------------------------------
+# ÉVÉNEMENTS EN DIRECT (LISTEN/NOTIFY -> server-sent events)
+# -------------------------------------------------------
+# Les triggers de la migration 16 publient clôtures, validations, anomalies
+# et commentaires sur EVENTS_CHANNEL. Chaque worker ouvre UNE connexion
+# dédiée (hors pool) qui écoute le canal et redistribue les événements aux
+# navigateurs abonnés à /events. Un abonné lent perd des événements (file
+# bornée) plutôt que de ralentir les autres.
+EVENTS_QUEUE_SIZE = 100
+EVENTS_HEARTBEAT = 15
+EVENTS_RECONNECT_DELAY = 5
+# chaque flux garde un thread du worker : au-delà, 503 et le navigateur
+# repasse au polling (/api/leader/tasks, /api/leader/counts)
+EVENTS_MAX_SUBSCRIBERS = int(os.environ.get("EVENTS_MAX_SUBSCRIBERS", str(WEB_THREADS // 2)))
+
+
+class _EventHub:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.thread = None
+        self.ready = threading.Event()
+        self.stats = {"received": 0, "delivered": 0, "dropped": 0, "reconnects": 0, "refused": 0}
+
+    def subscribe(self, accept, limit=None):
+        """Abonne `accept` ; None si `limit` abonnés sont déjà servis."""
+        sub = (queue.Queue(maxsize=EVENTS_QUEUE_SIZE), accept)
+        with self.lock:
+            if limit is not None and len(self.subscribers) >= limit:
+                self.stats["refused"] += 1
+                return None
+            self.subscribers.add(sub)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._listen, name="pmp-events", daemon=True)
+                self.thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+            self.stats["received"] += 1
+        for q, accept in subscribers:
+            if not accept(event):
+                continue
+            try:
+                q.put_nowait(event)
+                delivered = "delivered"
+            except queue.Full:
+                delivered = "dropped"
+            with self.lock:
+                self.stats[delivered] += 1
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(os.environ["DATABASE_URL"])
+                conn.set_session(autocommit=True)
+                conn.cursor().execute(f"LISTEN {EVENTS_CHANNEL}")
+                self.ready.set()
+                while True:
+                    if select.select([conn], [], [], EVENTS_HEARTBEAT) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            event = json.loads(notify.payload)
+                        except ValueError:
+                            continue
+                        self.publish(event)
+            except Exception as e:
+                self.ready.clear()
+                with self.lock:
+                    self.stats["reconnects"] += 1
+                print("⚠️ Écoute des événements interrompue:", repr(e))
+                time.sleep(EVENTS_RECONNECT_DELAY)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, subscribers=len(self.subscribers), listening=self.ready.is_set())
+
+
+_event_hub_state = {"hub": None, "pid": None}
+
+
+def event_hub():
+    # un hub (et donc un écouteur) par processus : recréé après fork
+    with _pool_lock:
+        if _event_hub_state["hub"] is None or _event_hub_state["pid"] != os.getpid():
+            _event_hub_state["hub"] = _EventHub()
+            _event_hub_state["pid"] = os.getpid()
+        return _event_hub_state["hub"]
+
+
+def _event_filter(user):
+    # chef d'équipe : événements de son équipe ; production / admin : tout
+    if user["role"] == "team_leader":
+        return lambda e: e.get("team_leader_id") == user["id"]
+    return lambda e: True
+
+
+@app.route("/events")
+@login_required(role=["team_leader", "production_manager", "admin"])
+def events_stream():
+    # pas de stream_with_context : la connexion du pool est rendue dès le
+    # retour de la vue, le flux ne garde qu'une file en mémoire
+    hub = event_hub()
+    sub = hub.subscribe(_event_filter(current_user()), limit=EVENTS_MAX_SUBSCRIBERS)
+    if sub is None:
+        resp = jsonify({"error": "trop de flux ouverts, utiliser le polling"})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = "60"
+        return resp
+
+    def generate():
+        try:
+            yield f"retry: {EVENTS_RECONNECT_DELAY * 1000}\n\n"
+            while True:
+                try:
+                    event = sub[0].get(timeout=EVENTS_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {event.get('type', 'message')}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            hub.unsubscribe(sub)
+
+    resp = Response(generate(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+@app.cli.command("check-events")
+@click.option("--triggers", is_flag=True,
+              help="Vérifier aussi le trigger des anomalies (insère puis supprime une ligne).")
+@click.option("--timeout", type=float, default=5.0, help="Attente maximale par événement (s).")
+def check_events_command(triggers, timeout):
+    """Vérifie la chaîne NOTIFY -> écouteur -> abonné sur la base configurée."""
+    hub = event_hub()
+    sub = hub.subscribe(lambda e: e.get("check") or e.get("type") == "anomaly")
+    try:
+        if not hub.ready.wait(timeout):
+            raise click.ClickException("écouteur non connecté")
+
+        def wait_for(match):
+            deadline = time.perf_counter() + timeout
+            while time.perf_counter() < deadline:
+                try:
+                    event = sub[0].get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if match(event):
+                    return event
+            return None
+
+        nonce = hashlib.sha1(os.urandom(8)).hexdigest()[:12]
+        db = get_db()
+        try:
+            c = db.cursor()
+            start = time.perf_counter()
+            c.execute("SELECT pg_notify(%s, %s)", (EVENTS_CHANNEL, json.dumps({"type": "check", "check": nonce})))
+            db.commit()
+            if not wait_for(lambda e: e.get("check") == nonce):
+                raise click.ClickException("NOTIFY non reçu")
+            click.echo(f"✅ NOTIFY reçu en {(time.perf_counter() - start) * 1000:.1f} ms")
+
+            if triggers:
+                c.execute("""
+                    INSERT INTO machine_anomalies(user_id, line, machine, description, severity)
+                    VALUES (NULL, 'CHECK', 'CHECK', %s, 'LOW')
+                    RETURNING id
+                """, (f"[check-events] {nonce}",))
+                anomaly_id = c.fetchone()["id"]
+                db.commit()
+                event = wait_for(lambda e: e.get("anomaly_id") == anomaly_id)
+                c.execute("DELETE FROM machine_anomalies WHERE id = %s", (anomaly_id,))
+                db.commit()
+                if not event:
+                    raise click.ClickException("événement anomalie non reçu")
+                click.echo("✅ trigger machine_anomalies -> événement reçu")
+        finally:
+            db.close()
+    finally:
+        hub.unsubscribe(sub)
 
+
+# -------------------------------------------------------
+# API : deltas des tableaux de bord opérateur / chef d'équipe
+# -------------------------------------------------------
+# ?since=<curseur> renvoie les tâches créées, clôturées ou validées depuis
+# le curseur (colonne updated_at, tenue par trigger). updated_at vaut NOW(),
+# le début de la transaction : une transaction encore en cours validera des
+# lignes datées d'avant les curseurs déjà rendus. Le curseur final est donc
+# plafonné au début de la plus ancienne transaction en cours (watermark) et
+# les requêtes sont rejouées avec DELTA_OVERLAP de recouvrement : le client
+# fusionne les tâches par id.
+# L'ETag est la date de la dernière modification du périmètre ; un
+# If-None-Match identique reçoit 304 sans lecture des tâches, sauf si une
+# transaction ouverte avant cette date peut encore y ajouter des lignes.
+DELTA_OVERLAP = timedelta(seconds=5)
+DELTA_INITIAL_WINDOW = timedelta(days=7)
+DELTA_MAX_ROWS = 500
+
+
+def _delta_watermark(c):
+    """Début de la plus ancienne transaction en cours (hors la nôtre), ou None."""
     c.execute("""
-        SELECT *
-        FROM tasks
-        ORDER BY created_at DESC
+        SELECT MIN(xact_start)::timestamp AS w
+        FROM pg_stat_activity
+        WHERE datname = current_database()
+        AND backend_type = 'client backend'
+        AND pid <> pg_backend_pid()
     """)
+    return c.fetchone()["w"]
 
-    tasks = c.fetchall()
 
+def _tasks_delta(scope, scope_sql, scope_params, select_sql):
+    since_arg = request.args.get("since")
+    if since_arg:
+        try:
+            since = datetime.fromisoformat(since_arg)
+        except ValueError:
+            return jsonify({"error": "since invalide"}), 400
+    else:
+        since = None
+
+    db = get_db()
+    c = db.cursor()
+    c.execute(f"SELECT MAX(t.updated_at) AS v FROM tasks t WHERE {scope_sql}", scope_params)
+    version = c.fetchone()["v"]
+    etag = f"{scope}-{version.isoformat() if version else 0}"
+    watermark = _delta_watermark(c)
+    # une transaction plus ancienne que `version` peut valider des lignes
+    # sans changer MAX(updated_at) : l'ETag ne prouve alors rien
+    cacheable = watermark is None or version is None or watermark > version
+
+    if since and cacheable and request.if_none_match.contains_weak(etag):
+        db.close()
+        resp = Response(status=304)
+        resp.set_etag(etag, weak=True)
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+
+    lower = since - DELTA_OVERLAP if since else datetime.now() - DELTA_INITIAL_WINDOW
+    c.execute(f"""
+        {select_sql}
+        WHERE {scope_sql}
+        AND t.updated_at > %s
+        ORDER BY t.updated_at, t.id
+        LIMIT %s
+    """, scope_params + [lower, DELTA_MAX_ROWS + 1])
+    rows = c.fetchall()
     db.close()
 
-    return render_template(
-        "production_dashboard.html",
-        tasks=tasks,
-        **kpi
+    more = len(rows) > DELTA_MAX_ROWS
+    rows = rows[:DELTA_MAX_ROWS]
+    cursor = rows[-1]["updated_at"] if rows else (since or version)
+    # dernière page : le client gardera ce curseur jusqu'au prochain appel
+    if not more and cursor and watermark and watermark < cursor:
+        cursor = watermark
+
+    resp = jsonify({
+        "tasks": [_task_json(r) for r in rows],
+        "since": cursor.isoformat() if cursor else None,
+        "more": more,
+    })
+    # page partielle : pas d'ETag, le client enchaîne avec le nouveau curseur
+    if not more and cacheable:
+        resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+@app.route("/api/me/tasks")
+@login_required()
+def api_me_tasks_delta():
+    user = current_user()
+    return _tasks_delta(
+        f"me{user['id']}",
+        "t.assigned_to = %s", [user["id"]],
+        f"SELECT {', '.join('t.' + f for f in TASK_API_FIELDS)} FROM tasks t"
+    )
+
+
+@app.route("/api/leader/counts")
+@login_required(role="team_leader")
+def api_leader_counts():
+    # compteurs du menu chef d'équipe, mis à jour sans recharger la page
+    return jsonify(leader_review_queue(current_user()["id"], limit=0)["counts"])
+
+
+@app.route("/api/leader/tasks")
+@login_required(role="team_leader")
+def api_leader_tasks_delta():
+    user = current_user()
+    return _tasks_delta(
+        f"team{user['id']}",
+        "t.assigned_to IN (SELECT id FROM users WHERE team_leader_id = %s)", [user["id"]],
+        f"""SELECT {', '.join('t.' + f for f in TASK_API_FIELDS)}, u.username
+        FROM tasks t JOIN users u ON u.id = t.assigned_to"""
     )
+
+
 @app.route("/admin/suggestions/treat/<string:type>/<int:fid>", methods=["POST"])
 @login_required(role="admin")
 def admin_treat_suggestion(type, fid):
@@ -1580,6 +4454,141 @@ def admin_treat_suggestion(type, fid):
     return redirect(url_for("admin_suggestions"))
 
 
+# -------------------------------------------------------
+# BENCHMARK : génération de tâches (ligne à ligne vs INSERT groupé)
+# -------------------------------------------------------
+@app.cli.command("bench-generation")
+@click.option("--tasks", "n_tasks", type=int, default=10_000, help="Nombre de tâches à générer.")
+def bench_generation_command(n_tasks):
+    """Compare l'insertion ligne à ligne et l'INSERT groupé (transaction annulée)."""
+    db = get_db()
+    c = db.cursor()
+    try:
+        c.execute("SELECT id FROM users ORDER BY id LIMIT 1")
+        user = c.fetchone()
+        if not user:
+            click.echo("Aucun utilisateur en base.")
+            return
+
+        now = datetime.now().isoformat()
+        rows = [
+            ("BENCH", f"Machine {i % 40}", f"Tâche {i}", user["id"],
+             "en_cours", 3, "Hebdomadaire", None, now)
+            for i in range(n_tasks)
+        ]
+
+        start = time.perf_counter()
+        for row in rows:
+            c.execute(f"""
+                INSERT INTO tasks ({", ".join(TASK_INSERT_COLUMNS)})
+                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+            """, row)
+        row_by_row = time.perf_counter() - start
+        db.rollback()
+
+        start = time.perf_counter()
+        ids = _insert_tasks(c, rows)
+        bulk = time.perf_counter() - start
+    finally:
+        db.rollback()
+        db.close()
+
+    click.echo(f"{n_tasks} tâches ligne à ligne : {row_by_row:.3f} s")
+    click.echo(f"{len(ids)} tâches INSERT groupé  : {bulk:.3f} s")
+    if bulk:
+        click.echo(f"gain x{row_by_row / bulk:.1f}")
+
+
+@app.cli.command("bench-assignment")
+@click.option("--templates", "n_templates", type=int, default=5_000, help="Nombre de modèles à affecter.")
+@click.option("--users", "n_users", type=int, default=300, help="Nombre d'utilisateurs.")
+@click.option("--machines", "n_machines", type=int, default=40, help="Nombre de machines.")
+def bench_assignment_command(n_templates, n_users, n_machines):
+    """Mesure la vitesse et l'équité de l'équilibrage (données synthétiques, sans base)."""
+    import random
+
+    rng = random.Random(0)
+    by_group = defaultdict(list)
+    for i in range(n_templates):
+        by_group[(f"Machine {i % n_machines}", "operator")].append({"Description": f"Tâche {i}"})
+
+    # chaque utilisateur couvre 1 à 3 machines et part d'une charge existante
+    users_by_group = defaultdict(list)
+    workload = {}
+    for u in range(1, n_users + 1):
+        for m in rng.sample(range(n_machines), rng.randint(1, 3)):
+            users_by_group[(f"Machine {m}", "operator")].append(u)
+        open_tasks = rng.randint(0, 20)
+        workload[u] = [3 * open_tasks, open_tasks]
+    reference_load = {u: list(load) for u, load in workload.items()}
+    initial_load = {u: load[0] for u, load in workload.items()}
+
+    start = time.perf_counter()
+    assignments, missing = _balanced_assignments(by_group, users_by_group, workload, points=3)
+    elapsed = time.perf_counter() - start
+
+    # référence O(tâches × utilisateurs) : min() à chaque tâche, même critère
+    start = time.perf_counter()
+    reference = []
+    for key, templates in by_group.items():
+        user_ids = sorted(set(users_by_group.get(key, [])))
+        if not user_ids:
+            continue
+        for r in templates:
+            u = min(user_ids, key=lambda x: (reference_load[x][0], reference_load[x][1], x))
+            reference.append((key, r, u))
+            reference_load[u][0] += 3
+            reference_load[u][1] += 1
+    ref_elapsed = time.perf_counter() - start
+
+    # équité rejouée groupe par groupe : à la fin d'un groupe, qui a reçu
+    # une tâche a au plus une tâche (3 points) d'avance sur le moins chargé
+    identical = assignments == reference
+    replay = dict(initial_load)
+    unfair = []
+    pos = 0
+    for key, templates in by_group.items():
+        user_ids = users_by_group.get(key, [])
+        if not user_ids:
+            continue
+        block = assignments[pos:pos + len(templates)]
+        pos += len(templates)
+        for _, _, u in block:
+            replay[u] += 3
+        spread = max(replay[u] for _, _, u in block) - min(replay[u] for u in user_ids)
+        if spread > 3:
+            unfair.append((key, spread))
+
+    loads = [load[0] for load in workload.values()]
+    click.echo(f"{len(assignments)} tâches / {n_users} utilisateurs")
+    click.echo(f"tas      : {elapsed * 1000:.1f} ms")
+    click.echo(f"min()    : {ref_elapsed * 1000:.1f} ms")
+    click.echo(f"affectations identiques à la référence : {identical}")
+    click.echo(f"groupes sans candidat : {len(missing)}")
+    click.echo(f"charge finale (points) : min {min(loads)}, max {max(loads)}")
+    click.echo(f"groupes à écart > 3 points : {len(unfair)}")
+
+    if not identical:
+        raise click.ClickException("affectations différentes de la référence min()")
+    if unfair:
+        key, spread = unfair[0]
+        raise click.ClickException(f"écart de charge {spread} points dans le groupe {key[0]}")
+
+
+# -------------------------------------------------------
+# ADMIN : statistiques internes (caches, pool, ...)
+# -------------------------------------------------------
+@app.route("/admin/stats")
+@login_required(role="admin")
+def admin_stats():
+    return jsonify({
+        "templates_cache": template_cache_stats(),
+        "db_pool": db_pool_stats(),
+        "operator_perf": perf_refresh_stats(),
+        "events": event_hub().snapshot(),
+    })
+
+
 # -------------------------------------------------------
 # CONTEXT PROCESSOR
 # -------------------------------------------------------